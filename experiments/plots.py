@@ -19,7 +19,7 @@ from loader.CELEGANS_dataset import CELEGANS
 from loader.PBMC_dataset import PBMC
 
 from models import load_pretrained
-from geometry import get_flattening_scores, get_Riemannian_metric
+from geometry import get_flattening_scores, get_Riemannian_metric, get_metric_spectrum
 
 from experiments.util import (
     load_model,
@@ -29,6 +29,7 @@ from experiments.util import (
 )
 
 from utils.config import Config
+from utils import smallmat
 from utils.utils import (
     get_sc_kwargs,
     get_saving_kwargs,
@@ -361,18 +362,18 @@ def cn_table(dataset_name, model_regs):
                     metric = get_flattening_scores(G, mode=metric_mode)
                     """
 
+                    S = get_metric_spectrum(G)
+
                     if model_name == "confae-log":
-                        S = torch.svd(G).S
                         metric_inp = torch.abs(1 - S.min(1).values/S.max(1).values)  # inverted condition number -1
                         metric_inp = metric_inp[values_in_quantile(metric_inp, 0.90)]
                         metric = torch.mean(metric_inp)
                     elif model_name == "geomae":
-                        Slog = torch.log(torch.svd(G).S)
+                        Slog = torch.log(S)
                         metric_inp = Slog.sum(1)
                         metric_inp = metric_inp[values_in_quantile(metric_inp, 0.90)]
                         metric = torch.std(metric_inp)
                     elif model_name == "irae":
-                        S = torch.svd(G).S
                         metric_inp = torch.log(S).flatten()
                         metric_inp = metric_inp[values_in_quantile(metric_inp, 0.90)]
                         metric = torch.std(metric_inp)
@@ -501,7 +502,7 @@ def indicatrix_plot(model, model_name, dataset_name, reg, test_dl, train_dl):
 
     G = get_Riemannian_metric(model, points.view(points.shape[0], -1), "vis")
     if config["part_of_ae"]["vis"] == "encoder":
-        G = torch.inverse(G)
+        G = smallmat.inv(G)
     # print(G.shape)
 
     vector_patches, _ = generate_unit_vectors(100, points, G)
@@ -652,6 +653,7 @@ def determinants_plot(
     test_dl,
     quantile=1.0,
     batch_size=-1,
+    memory_budget=2**30,
     scaling="asinh",
     grid="dataset",
     num_steps=15,
@@ -671,9 +673,9 @@ def determinants_plot(
     data = data[perm]  # [:num_data]
     latent_activations = latent_activations[perm]  # [:num_data]
 
-    # batch-size is negative use the whole batch, i.e. don't batch. Need to batch for storage reasons
+    # batch-size is negative: choose the chunks such that they fit into memory_budget (bytes)
     if batch_size == -1:
-        batch_size = latent_activations.shape[0]
+        batch_size = None
 
     if config["part_of_ae"]["vis"] == "encoder":
         model = model.encode
@@ -682,23 +684,16 @@ def determinants_plot(
         model = model.decode
         points = latent_activations
 
-    #G = []
-    #num_data = 100
-    #for i in range(0, points.shape[0], num_data):
-    #    print(i)
-    #    batch = points[i:i+num_data]
-    #    G_new = get_Riemannian_metric(model, batch.view(batch.shape[0], -1), "vis")
-    #    G.append(G_new)
-    #G = torch.cat(G)
-
-    G = get_Riemannian_metric(model, points.view(points.shape[0], -1), "vis")
+    # no graph is needed here, so nothing is kept alive across chunks
+    with torch.no_grad():
+        G = get_Riemannian_metric(
+            model, points.view(points.shape[0], -1), "vis", chunk_size=batch_size, memory_budget=memory_budget
+        )
 
     # calculate determinants
     # G = get_pushforwarded_Riemannian_metric(model.encode, data.view(data.shape[0], -1))
     
-    determinants = torch.det(
-        G
-    ).sqrt()
+    determinants = get_metric_spectrum(G).prod(1).sqrt()
 
     # collapse determinants into quantile
     middle_idx = values_in_quantile(determinants, quantile)
@@ -0,0 +1,20 @@
+#!/bin/bash
+
+#SBATCH --job-name=mnist_geomae_ensemble
+#SBATCH --partition=a40
+#SBATCH --nodes=1
+#SBATCH --ntasks-per-node=8
+#SBATCH --gres=gpu:1
+#SBATCH --gres-flags=enforce-binding
+#SBATCH --time=30-00:00:00
+#SBATCH --output %j.out
+#SBATCH --error %j.err
+
+# all seeds and regs of run_geomae.sh in one process
+python3 source/train.py \
+--base_config configs/mnist/base_config.yml \
+--config configs/mnist/geomae.yml \
+--ensemble configs/ensemble.yml \
+--logdir results2/mnist_z2 \
+--run geomae_ensemble \
+--device $1
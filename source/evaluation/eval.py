@@ -56,7 +56,8 @@ class Multi_Evaluation:
         return results
 
 
-    def get_multi_evals(self, data, latent, labels, ks):
+    def get_multi_evals(self, data, latent, labels, ks, metrics=None, knn_only=False, measures=None,
+                        n_landmarks=1000):
         '''
         Performs multiple evaluations for nonlinear dimensionality
         reduction.
@@ -64,12 +65,17 @@ class Multi_Evaluation:
         - data: data samples as matrix
         - latent: latent samples as matrix
         - labels: labels of samples
+        - metrics: optional Riemannian metric of the latent space at the latent samples, for the geodesic measures
+        - knn_only: compute the measures without n times n matrices, see MeasureCalculator
+        - measures: names of the measures to compute, may contain wildcards (e.g. 'density_kl_global_*'), all if None
+        - n_landmarks: number of source points of the geodesic measures, all if None
         '''
 
-        calc = MeasureCalculator(data, latent, max(ks))
+        calc = MeasureCalculator(
+            data, latent, max(ks), metrics=metrics, knn_only=knn_only, n_landmarks=n_landmarks
+        )
 
-        indep_measures = calc.compute_k_independent_measures()
-        dep_measures = calc.compute_measures_for_ks(ks)
+        indep_measures, dep_measures = calc.compute_measures(ks, names=measures)
         mean_dep_measures = {
             'mean_' + key: values.mean() for key, values in dep_measures.items()
         }
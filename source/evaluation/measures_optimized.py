@@ -3,11 +3,18 @@ THIS FILE WAS TAKEN FROM https://github.com/BorgwardtLab/topological-autoencoder
 """
 
 
+import warnings
+from fnmatch import fnmatch
+
 import numpy as np
 import scipy
+import scipy.sparse
+from scipy.sparse.csgraph import dijkstra
 import torch
-from scipy.spatial.distance import pdist, squareform
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import pdist, squareform, cdist
 from sklearn.metrics import pairwise_distances
+from sklearn.neighbors import NearestNeighbors
 
 from torch.nn.functional import pdist as pdist_torch
 
@@ -18,63 +25,342 @@ class MeasureRegistrator():
     """Keeps track of measurements in Measure Calculator."""
     k_independent_measures = {}
     k_dependent_measures = {}
+    # k dependent measures that are computed for several ks at once, by name of the k dependent measure
+    k_vectorized_measures = {}
+    # intermediates of the MeasureCalculator each measure reads, by name of the measure
+    requirements = {}
 
-    def register(self, is_k_dependent):
+    def register(self, is_k_dependent, requires=()):
         def k_dep_fn(measure):
             self.k_dependent_measures[measure.__name__] = measure
+            self.requirements[measure.__name__] = tuple(requires)
             return measure
 
         def k_indep_fn(measure):
             self.k_independent_measures[measure.__name__] = measure
+            self.requirements[measure.__name__] = tuple(requires)
             return measure
 
         if is_k_dependent:
             return k_dep_fn
         return k_indep_fn
 
+    def register_for_ks(self, name):
+        def ks_fn(measure):
+            self.k_vectorized_measures[name] = measure
+            return measure
+
+        return ks_fn
+
     def get_k_independent_measures(self):
         return self.k_independent_measures
 
     def get_k_dependent_measures(self):
         return self.k_dependent_measures
 
+    def get_k_vectorized_measures(self):
+        return self.k_vectorized_measures
+
+    def get_requirements(self, name):
+        return self.requirements.get(name, ())
+
 
 class MeasureCalculator():
+    """
+    The intermediates of the measures (pairwise distances, neighbourhoods, ranks, ...) are built lazily on first use
+    and memoised, see _get. Every measure declares the intermediates it reads, so that compute_measures builds only
+    what the requested measures need and releases intermediates once no remaining measure needs them.
+    """
     measures = MeasureRegistrator()
-
-    def __init__(self, X, Z, k_max):
-        self.k_max = k_max
-        self.pairwise_X = squareform(pdist(X))
-        self.pairwise_Z = squareform(pdist(Z))
+    # sigmas of the density measures, their kernels are accumulated in one pass over the distances
+    density_sigmas = (0.1, 100.)
+    # intermediates and the intermediates they are built from
+    dependencies = {
+        "pairwise": (),
+        "neighbours": ("pairwise",),
+        "ranks": ("pairwise",),
+        "gathered_ranks": ("neighbours", "ranks"),
+        "shared_neighbours": ("neighbours",),
+        "max_distances": ("pairwise",),
+        "distance_sums": ("pairwise",),
+        "densities": ("pairwise", "max_distances"),
+        "geodesics": (),
+    }
+
+    def __init__(self, X, Z, k_max, metrics=None, n_graph_neighbours=10, n_landmarks=1000, seed=42,
+                 knn_only=False, block_size=2 ** 22):
+        """
+        - metrics,              optional Riemannian metric of the latent space at each point of Z [n times d times d],
+                                used to weight the edges of the latent kNN graph of the geodesic measures
+        - n_graph_neighbours,   number of neighbours of the kNN graphs of the geodesic measures
+        - n_landmarks,          number of source points of the geodesic distances (all points if None,
+                                which needs n times n geodesic distances)
+        - knn_only,             keep only the k_max neighbourhoods and the ranks the measures need instead of the
+                                n times n distance and rank matrices, distances are computed in blocks of rows
+        - block_size,           number of distances per block with knn_only
+        """
+        # a sample has at most n - 1 neighbours
+        self.k_max = min(int(k_max), len(X) - 1)
         self.X = X
         self.Z = Z
-
-        self.neighbours_X, self.ranks_X = \
-            self._neighbours_and_ranks(self.pairwise_X, k_max)
-        self.neighbours_Z, self.ranks_Z = \
-            self._neighbours_and_ranks(self.pairwise_Z, k_max)
+        self.metrics = metrics
+        self.n_graph_neighbours = n_graph_neighbours
+        self.n_landmarks = n_landmarks
+        self.seed = seed
+        self.knn_only = knn_only
+        self.block_size = block_size
+        # memoised intermediates by name, (name, parameter) for parametrised ones
+        self._cache = {}
+        # intermediates the requested measures need, None if unknown
+        self._needed = None
+
+    def _get(self, name):
+        """the intermediate name, built by _build_<name> on first use"""
+        if name not in self._cache:
+            self._cache[name] = getattr(self, f"_build_{name}")()
+        return self._cache[name]
+
+    def _needed_intermediates(self, names):
+        """the intermediates the measures names read, and those still to be built for them"""
+        needed = set()
+        stack = [req for name in names for req in self.measures.get_requirements(name)]
+        while stack:
+            name = stack.pop()
+            if name in needed:
+                continue
+            needed.add(name)
+            built = any(key == name or (isinstance(key, tuple) and key[0] == name) for key in self._cache)
+            if not built:
+                stack.extend(self.dependencies[name])
+        return needed
+
+    def _release(self, remaining):
+        """drop the intermediates that none of the remaining measures needs"""
+        needed = self._needed_intermediates(remaining)
+        for key in list(self._cache):
+            if (key[0] if isinstance(key, tuple) else key) not in needed:
+                del self._cache[key]
+
+    @property
+    def pairwise_X(self):
+        """distance matrix in X [n times n], expanded from the condensed distances on every access"""
+        return squareform(self._get("pairwise")[0])
+
+    @property
+    def pairwise_Z(self):
+        """distance matrix in Z [n times n], expanded from the condensed distances on every access"""
+        return squareform(self._get("pairwise")[1])
+
+    @property
+    def neighbours_X(self):
+        return self._get("neighbours")[0]
+
+    @property
+    def neighbours_Z(self):
+        return self._get("neighbours")[1]
+
+    @property
+    def ranks_X(self):
+        return self._get("ranks")[0]
+
+    @property
+    def ranks_Z(self):
+        return self._get("ranks")[1]
+
+    def _build_pairwise(self):
+        if self.knn_only:
+            raise RuntimeError("the pairwise distance matrices are not built with knn_only, see _distance_blocks")
+        # condensed (the pairs i < j only) and in single precision, an eighth of the square float64 matrices
+        return pdist(self.X).astype(np.float32), pdist(self.Z).astype(np.float32)
+
+    def _build_neighbours(self):
+        if self.knn_only:
+            # the ranks come from the same pass over the distances, if any requested measure needs them
+            self._knn_pass(with_ranks=self._needed is None or "gathered_ranks" in self._needed)
+            return self._cache["neighbours"]
+        return tuple(self._nearest(squareform(condensed), self.k_max) for condensed in self._get("pairwise"))
+
+    def _build_ranks(self):
+        if self.knn_only:
+            raise RuntimeError("the rank matrices are not built with knn_only, see get_gathered_ranks")
+        return tuple(self._ranks(squareform(condensed)) for condensed in self._get("pairwise"))
+
+    def _build_gathered_ranks(self):
+        if self.knn_only:
+            self._knn_pass(with_ranks=True)
+            return self._cache["gathered_ranks"]
+        rows = np.arange(len(self.X))[:, None]
+        return self.ranks_X[rows, self.neighbours_Z], self.ranks_Z[rows, self.neighbours_X]
+
+    def _build_max_distances(self):
+        if not self.knn_only:
+            return tuple(condensed.max() for condensed in self._get("pairwise"))
+        max_X, max_Z = 0.0, 0.0
+        for distances_X, distances_Z in self._distance_blocks():
+            max_X, max_Z = max(max_X, distances_X.max()), max(max_Z, distances_Z.max())
+        return max_X, max_Z
 
     @staticmethod
-    def _neighbours_and_ranks(distances, k):
+    def _ranks(distances):
         """
         Inputs: 
         - distances,        distance matrix [n times n], 
-        - k,                number of nearest neighbours to consider
         Returns:
-        - neighbourhood,    contains the sample indices (from 0 to n-1) of kth nearest neighbor of current sample [n times k]
         - ranks,            contains the rank of each sample to each sample [n times n], whereas entry (i,j) gives the rank that sample j has to i (the how many 'closest' neighbour j is to i) 
         """
-        # Warning: this is only the ordering of neighbours that we need to
-        # extract neighbourhoods below. The ranking comes later!
+        # Warning: this is only the ordering of neighbours. The ranking comes later!
         indices = np.argsort(distances, axis=-1, kind='stable')
 
-        # Extract neighbourhoods.
-        neighbourhood = indices[:, 1:k + 1]
-
         # Convert this into ranks (finally)
-        ranks = indices.argsort(axis=-1, kind='stable')
+        return indices.argsort(axis=-1, kind='stable')
 
-        return neighbourhood, ranks
+    @staticmethod
+    def _nearest(distances, k):
+        """
+        Inputs:
+        - distances,        distances of a block of samples to all samples [b times n]
+        - k,                number of nearest neighbours to consider
+        Returns:
+        - neighbourhood,    the k nearest neighbours in the order of a stable argsort, without the first
+                            (the sample itself) [b times k]
+        """
+        candidates = np.argpartition(distances, k, axis=-1)[:, :k + 1]
+        candidate_distances = np.take_along_axis(distances, candidates, axis=-1)
+        order = np.lexsort((candidates, candidate_distances), axis=-1)
+        neighbourhood = np.take_along_axis(candidates, order, axis=-1)[:, 1:]
+
+        # argpartition picks arbitrarily among samples tied at the (k+1)th distance,
+        # rows with such ties take the k nearest of a stable argsort instead
+        boundary = candidate_distances.max(axis=-1, keepdims=True)
+        tied = np.flatnonzero((distances <= boundary).sum(axis=-1) > k + 1)
+        if len(tied) > 0:
+            neighbourhood[tied] = np.argsort(distances[tied], axis=-1, kind='stable')[:, 1:k + 1]
+        return neighbourhood
+
+    @staticmethod
+    def _ranks_of(distances, neighbours):
+        """
+        ranks of the neighbours [b times k] of a block of samples with the distances [b times n] to all samples,
+        i.e. the number of samples that are closer to the sample than the neighbour, or as close with a smaller
+        index, as the position in a stable argsort
+        """
+        sorted_distances = np.sort(distances, axis=-1)
+        neighbour_distances = np.take_along_axis(distances, neighbours, axis=-1)
+        ranks = np.empty(neighbours.shape, dtype=np.int64)
+        for i, (row, queries) in enumerate(zip(sorted_distances, neighbour_distances)):
+            ranks[i] = np.searchsorted(row, queries, side='left')
+            tied = np.flatnonzero(np.searchsorted(row, queries, side='right') - ranks[i] > 1)
+            if len(tied) > 0:
+                equal = distances[i] == queries[tied, None]
+                ranks[i, tied] += (equal & (np.arange(distances.shape[1]) < neighbours[i, tied, None])).sum(axis=-1)
+        return ranks
+
+    def _condensed_chunks(self):
+        """
+        consecutive chunks (start, end) of block_size entries of the condensed distances, with the rows and columns
+        of their entries in the distance matrix
+        """
+        n = len(self.X)
+        # offset of the pairs (i, j > i) of row i
+        offsets = np.arange(n) * n - np.arange(n) * (np.arange(n) + 1) // 2
+        n_pairs = n * (n - 1) // 2
+        for start in range(0, n_pairs, self.block_size):
+            end = min(start + self.block_size, n_pairs)
+            index = np.arange(start, end)
+            rows = np.searchsorted(offsets, index, side='right') - 1
+            cols = index - offsets[rows] + rows + 1
+            yield start, end, rows, cols
+
+    def _distance_blocks(self):
+        """
+        distances in X and in Z of consecutive blocks of samples to all samples,
+        a single block of the full matrices without knn_only
+        """
+        if not self.knn_only:
+            yield self.pairwise_X, self.pairwise_Z
+            return
+        n = len(self.X)
+        n_rows = max(1, self.block_size // n)
+        for start in range(0, n, n_rows):
+            yield cdist(self.X[start:start + n_rows], self.X), cdist(self.Z[start:start + n_rows], self.Z)
+
+    def _tree_nearest(self, tree, k):
+        """
+        the k nearest neighbours of all samples of Z from a KD-tree, in the (distance, index) order of _nearest.
+        Rows with samples tied at the (k+1)th distance, of which the tree returns an arbitrary subset,
+        are recomputed from their distances to all samples.
+        """
+        distances, candidates = tree.query(self.Z, k=k + 1)
+        order = np.lexsort((candidates, distances), axis=-1)
+        neighbourhood = np.take_along_axis(candidates, order, axis=-1)[:, 1:]
+
+        n_within = tree.query_ball_point(self.Z, r=distances[:, -1], return_length=True)
+        tied = np.flatnonzero(n_within > k + 1)
+        n_rows = max(1, self.block_size // len(self.Z))
+        for start in range(0, len(tied), n_rows):
+            rows = tied[start:start + n_rows]
+            neighbourhood[rows] = self._nearest(cdist(self.Z[rows], self.Z), k)
+        return neighbourhood
+
+    def _knn_pass(self, with_ranks=True):
+        """
+        k_max neighbourhoods, the maximal distances and with_ranks the gathered ranks (see get_gathered_ranks)
+        from one pass over blocks of distances, in O(n k_max + block_size) memory.
+        Low dimensional latent neighbourhoods come from a KD-tree.
+        """
+        n, k_max = len(self.X), self.k_max
+        tree_Z = cKDTree(self.Z) if self.Z.shape[1] <= 3 else None
+        if tree_Z is not None:
+            neighbours_Z = self._tree_nearest(tree_Z, k_max)
+        else:
+            neighbours_Z = np.empty((n, k_max), dtype=np.int64)
+        neighbours_X = np.empty((n, k_max), dtype=np.int64)
+        if with_ranks:
+            X_ranks_of_Z = np.empty((n, k_max), dtype=np.int64)
+            Z_ranks_of_X = np.empty((n, k_max), dtype=np.int64)
+        max_X, max_Z = 0.0, 0.0
+
+        start = 0
+        for distances_X, distances_Z in self._distance_blocks():
+            rows = slice(start, start + len(distances_X))
+            neighbours_X[rows] = self._nearest(distances_X, k_max)
+            if tree_Z is None:
+                neighbours_Z[rows] = self._nearest(distances_Z, k_max)
+            if with_ranks:
+                X_ranks_of_Z[rows] = self._ranks_of(distances_X, neighbours_Z[rows])
+                Z_ranks_of_X[rows] = self._ranks_of(distances_Z, neighbours_X[rows])
+            max_X, max_Z = max(max_X, distances_X.max()), max(max_Z, distances_Z.max())
+            start = rows.stop
+
+        self._cache["neighbours"] = neighbours_X, neighbours_Z
+        self._cache["max_distances"] = max_X, max_Z
+        if with_ranks:
+            self._cache["gathered_ranks"] = X_ranks_of_Z, Z_ranks_of_X
+
+    def _build_shared_neighbours(self):
+        n, k_max = self.neighbours_X.shape
+        # sorted set intersection of the neighbour lists of each sample: after sorting the concatenated lists,
+        # a shared neighbour occupies two adjacent entries
+        neighbours = np.concatenate([self.neighbours_X, self.neighbours_Z], axis=1)
+        positions = np.broadcast_to(np.tile(np.arange(1, k_max + 1), 2), neighbours.shape)
+        order = np.argsort(neighbours, axis=-1, kind='stable')
+        neighbours = np.take_along_axis(neighbours, order, axis=-1)
+        positions = np.take_along_axis(positions, order, axis=-1)
+
+        shared = neighbours[:, 1:] == neighbours[:, :-1]
+        # a neighbour at position j in X and j' in Z is shared from k = max(j, j') on
+        shared_from = np.maximum(positions[:, 1:], positions[:, :-1])[shared]
+        return np.cumsum(np.bincount(shared_from, minlength=k_max + 1))
+
+    def get_shared_neighbours(self):
+        """
+        number of neighbours shared by the k-neighbourhoods in X and in Z, summed over the samples,
+        for all k from 0 to k_max [k_max + 1]
+        """
+        return self._get("shared_neighbours")
+
+    def get_max_distances(self):
+        return self._get("max_distances")
 
     def get_X_neighbours_and_ranks(self, k):
         return self.neighbours_X[:, :k], self.ranks_X
@@ -82,75 +368,175 @@ class MeasureCalculator():
     def get_Z_neighbours_and_ranks(self, k):
         return self.neighbours_Z[:, :k], self.ranks_Z
 
-    def compute_k_independent_measures(self):
+    @staticmethod
+    def _select(available, names):
+        """the measures of available matching one of the names, which may contain shell-style wildcards"""
+        if names is None:
+            return available
+        return {key: fn for key, fn in available.items() if any(fnmatch(key, name) for name in names)}
+
+    def compute_k_independent_measures(self, names=None):
         return {key: fn(self) for key, fn in
-                self.measures.get_k_independent_measures().items()}
+                self._select(self.measures.get_k_independent_measures(), names).items()}
 
-    def compute_k_dependent_measures(self, k):
+    def compute_k_dependent_measures(self, k, names=None):
         return {key: fn(self, k) for key, fn in
-                self.measures.get_k_dependent_measures().items()}
+                self._select(self.measures.get_k_dependent_measures(), names).items()}
 
-    def compute_measures_for_ks(self, ks):
+    def _valid_ks(self, ks):
+        """
+        the ks up to k_max, or k_max alone if there are none (fewer samples than the ks ask for),
+        warns about the ks that are dropped
+        """
+        ks = np.asarray(ks)
+        valid = ks[ks <= self.k_max]
+        if len(valid) == 0:
+            valid = np.array([self.k_max])
+        if len(valid) < len(ks):
+            warnings.warn(
+                f"ks {ks[ks > self.k_max].tolist()} exceed k_max = {self.k_max} ({len(self.X)} samples), "
+                f"the k dependent measures are computed for ks {valid.tolist()}"
+            )
+        return valid
+
+    def _compute_for_ks(self, key, fn, ks):
+        """the measure key for each of the ks, which have to be valid (see _valid_ks)"""
+        vectorized = self.measures.get_k_vectorized_measures()
+        if key in vectorized:
+            return np.asarray(vectorized[key](self, ks))
+        return np.array([fn(self, k) for k in ks])
+
+    def compute_measures_for_ks(self, ks, names=None):
+        ks = self._valid_ks(ks)
         return {
-            key: np.array([fn(self, k) for k in ks])
-            for key, fn in self.measures.get_k_dependent_measures().items()
+            key: self._compute_for_ks(key, fn, ks)
+            for key, fn in self._select(self.measures.get_k_dependent_measures(), names).items()
         }
 
-    @measures.register(False)
+    def compute_measures(self, ks, names=None):
+        """
+        The k independent measures and the k dependent measures for all ks, restricted to names (all if None).
+        Builds only the intermediates of these measures and releases each after its last use.
+        """
+        independent = self._select(self.measures.get_k_independent_measures(), names)
+        dependent = self._select(self.measures.get_k_dependent_measures(), names)
+        remaining = list(independent) + list(dependent)
+        self._needed = self._needed_intermediates(remaining)
+        if dependent:
+            ks = self._valid_ks(ks)
+
+        indep_measures, dep_measures = {}, {}
+        for key, fn in independent.items():
+            indep_measures[key] = fn(self)
+            remaining.remove(key)
+            self._release(remaining)
+        for key, fn in dependent.items():
+            dep_measures[key] = self._compute_for_ks(key, fn, ks)
+            remaining.remove(key)
+            self._release(remaining)
+
+        self._needed = None
+        return indep_measures, dep_measures
+
+    def get_gathered_ranks(self):
+        """
+        Ranks gathered once for all ks up to k_max:
+        - X_ranks_of_Z,     rank in X of the jth nearest neighbour in Z of each sample [n times k_max]
+        - Z_ranks_of_X,     rank in Z of the jth nearest neighbour in X of each sample [n times k_max]
+        The jth nearest neighbour in its own space has rank j (column j - 1).
+        """
+        return self._get("gathered_ranks")
+
+    def _build_distance_sums(self):
+        """sums over the distance matrices of the squared differences and of the squares of the latent distances"""
+        sum_of_squared_differences, sum_of_squares = 0.0, 0.0
+        if self.knn_only:
+            for distances_X, distances_Z in self._distance_blocks():
+                sum_of_squared_differences += np.square(distances_X - distances_Z).sum()
+                sum_of_squares += np.square(distances_Z).sum()
+            return sum_of_squared_differences, sum_of_squares
+
+        condensed_X, condensed_Z = self._get("pairwise")
+        for start in range(0, len(condensed_X), self.block_size):
+            chunk_X = condensed_X[start:start + self.block_size]
+            chunk_Z = condensed_Z[start:start + self.block_size]
+            sum_of_squared_differences += np.square(chunk_X - chunk_Z).sum(dtype=np.float64)
+            sum_of_squares += np.square(chunk_Z).sum(dtype=np.float64)
+        # every pair appears twice in the symmetric matrices
+        return 2 * sum_of_squared_differences, 2 * sum_of_squares
+
+    @measures.register(False, requires=("distance_sums",))
     def stress(self):
-        sum_of_squared_differences = \
-            np.square(self.pairwise_X - self.pairwise_Z).sum()
-        sum_of_squares = np.square(self.pairwise_Z).sum()
+        sum_of_squared_differences, sum_of_squares = self._get("distance_sums")
 
         return np.sqrt(sum_of_squared_differences / sum_of_squares)
 
-    @measures.register(False)
+    @measures.register(False, requires=("distance_sums",))
     def rmse(self):
         """
         rmse of between the distance matrix in input- and latent-space
         """
-        n = self.pairwise_X.shape[0]
-        sum_of_squared_differences = np.square(
-            self.pairwise_X - self.pairwise_Z).sum()
+        n = len(self.X)
+        sum_of_squared_differences, _ = self._get("distance_sums")
         return np.sqrt(sum_of_squared_differences / n ** 2)
 
     @staticmethod
-    def _trustworthiness(X_neighbourhood, X_ranks, Z_neighbourhood,
-                         Z_ranks, n, k):
-        '''
-        Calculates the trustworthiness measure between the data space `X`
-        and the latent space `Z`, given a neighbourhood parameter `k` for
-        defining the extent of neighbourhoods.
+    def _missing_rank_sums(foreign_ranks):
         '''
+        For all k from 1 to k_max, the sum over the samples and their $k$
+        nearest neighbours in one space that are not among the $k$ nearest
+        neighbours in the other space of (rank in the other space - k).
 
-        result = 0.0
+        - foreign_ranks,    rank in the other space of the jth nearest neighbour of each sample [n times k_max]
 
-        # Calculate number of neighbours that are in the $k$-neighbourhood
-        # of the latent space but not in the $k$-neighbourhood of the data
-        # space.
-        for row in range(X_ranks.shape[0]):
-            missing_neighbours = np.setdiff1d(
-                Z_neighbourhood[row],
-                X_neighbourhood[row]
-            )
+        The neighbour in column j - 1 with foreign rank r is missing for j <= k < r,
+        so the sums are cumulative sums over the starts and ends of these intervals.
+        '''
+        k_max = foreign_ranks.shape[1]
+        starts = np.broadcast_to(np.arange(1, k_max + 1), foreign_ranks.shape)
+        # rank 0 (a duplicate of the sample itself) is never among the neighbours
+        ends = np.where(foreign_ranks >= 1, np.minimum(foreign_ranks - 1, k_max), k_max)
+        valid = starts <= ends
+        starts, ends = starts[valid], ends[valid] + 1
+        ranks = foreign_ranks[valid].astype(np.float64)
+
+        counts = np.bincount(starts, minlength=k_max + 2) - np.bincount(ends, minlength=k_max + 2)
+        rank_sums = np.bincount(starts, weights=ranks, minlength=k_max + 2) \
+            - np.bincount(ends, weights=ranks, minlength=k_max + 2)
+        counts = np.cumsum(counts)[1:k_max + 1]
+        rank_sums = np.cumsum(rank_sums)[1:k_max + 1]
+        return rank_sums - np.arange(1, k_max + 1) * counts
 
-            for neighbour in missing_neighbours:
-                result += (X_ranks[row, neighbour] - k)
+    @staticmethod
+    def _trustworthiness_for_ks(foreign_ranks, n, ks):
+        '''
+        Calculates the trustworthiness measure between two spaces for all
+        neighbourhood parameters `ks`, from the ranks in the first space of
+        the nearest neighbours in the second space.
+        '''
+        ks = np.asarray(ks)
+        result = MeasureCalculator._missing_rank_sums(foreign_ranks)[ks - 1]
+        return 1 - 2 / (n * ks * (2 * n - 3 * ks - 1)) * result
 
-        return 1 - 2 / (n * k * (2 * n - 3 * k - 1)) * result
+    @measures.register_for_ks("trustworthiness")
+    def trustworthiness_for_ks(self, ks):
+        X_ranks_of_Z, _ = self.get_gathered_ranks()
+        return self._trustworthiness_for_ks(X_ranks_of_Z, len(X_ranks_of_Z), ks)
 
-    @measures.register(True)
+    @measures.register(True, requires=("gathered_ranks",))
     def trustworthiness(self, k):
         """
         Measures the preservation of k nearest neighbor graph
         """
-        X_neighbourhood, X_ranks = self.get_X_neighbours_and_ranks(k)
-        Z_neighbourhood, Z_ranks = self.get_Z_neighbours_and_ranks(k)
-        n = self.pairwise_X.shape[0]
-        return self._trustworthiness(X_neighbourhood, X_ranks, Z_neighbourhood,
-                                     Z_ranks, n, k)
+        return self.trustworthiness_for_ks([k])[0]
+
+    @measures.register_for_ks("continuity")
+    def continuity_for_ks(self, ks):
+        _, Z_ranks_of_X = self.get_gathered_ranks()
+        # Notice that the spaces are flipped here.
+        return self._trustworthiness_for_ks(Z_ranks_of_X, len(Z_ranks_of_X), ks)
 
-    @measures.register(True)
+    @measures.register(True, requires=("gathered_ranks",))
     def continuity(self, k):
         '''
         Calculates the continuity measure between the data space `X` and the
@@ -159,40 +545,33 @@ class MeasureCalculator():
 
         This is just the 'flipped' variant of the 'trustworthiness' measure.
         '''
+        return self.continuity_for_ks([k])[0]
 
-        X_neighbourhood, X_ranks = self.get_X_neighbours_and_ranks(k)
-        Z_neighbourhood, Z_ranks = self.get_Z_neighbours_and_ranks(k)
-        n = self.pairwise_X.shape[0]
-        # Notice that the parameters have to be flipped here.
-        return self._trustworthiness(Z_neighbourhood, Z_ranks, X_neighbourhood,
-                                     X_ranks, n, k)
+    @measures.register_for_ks("neighbourhood_loss")
+    def neighbourhood_loss_for_ks(self, ks):
+        ks = np.asarray(ks)
+        n = len(self.X)
+        return 1.0 - self.get_shared_neighbours()[ks] / (n * ks)
 
-    @measures.register(True)
+    @measures.register(True, requires=("shared_neighbours",))
     def neighbourhood_loss(self, k):
         '''
         Calculates the neighbourhood loss quality measure between the data
         space `X` and the latent space `Z` for some neighbourhood size $k$
         that has to be pre-defined.
         '''
-
-        X_neighbourhood, _ = self.get_X_neighbours_and_ranks(k)
-        Z_neighbourhood, _ = self.get_Z_neighbours_and_ranks(k)
-
-        result = 0.0
-        n = self.pairwise_X.shape[0]
-
-        for row in range(n):
-            shared_neighbours = np.intersect1d(
-                X_neighbourhood[row],
-                Z_neighbourhood[row],
-                assume_unique=True
-            )
-
-            result += len(shared_neighbours) / k
-
-        return 1.0 - result / n
-
-    @measures.register(True)
+        return self.neighbourhood_loss_for_ks([k])[0]
+
+    @measures.register_for_ks("rank_correlation")
+    def rank_correlation_for_ks(self, ks):
+        _, Z_ranks_of_X = self.get_gathered_ranks()
+        # we go from X to Z here, the ranks in X of the neighbours in X are 1..k
+        X_ranks_of_X = np.broadcast_to(np.arange(1, Z_ranks_of_X.shape[1] + 1), Z_ranks_of_X.shape)
+        return np.array([
+            spearmanr(X_ranks_of_X[:, :k].ravel(), Z_ranks_of_X[:, :k].ravel())[0] for k in ks
+        ])
+
+    @measures.register(True, requires=("gathered_ranks",))
     def rank_correlation(self, k):
         '''
         Calculates the spearman rank correlation of the data
@@ -200,28 +579,10 @@ class MeasureCalculator():
         nearest neighbours.
         '''
 
-        X_neighbourhood, X_ranks = self.get_X_neighbours_and_ranks(k)
-        Z_neighbourhood, Z_ranks = self.get_Z_neighbours_and_ranks(k)
-
-        n = self.pairwise_X.shape[0]
-        # we gather
-        gathered_ranks_x = []
-        gathered_ranks_z = []
-        for row in range(n):
-            # we go from X to Z here:
-            for neighbour in X_neighbourhood[row]:
-                rx = X_ranks[row, neighbour]
-                rz = Z_ranks[row, neighbour]
-                gathered_ranks_x.append(rx)
-                gathered_ranks_z.append(rz)
-        rs_x = np.array(gathered_ranks_x)
-        rs_z = np.array(gathered_ranks_z)
-        coeff, _ = spearmanr(rs_x, rs_z)
-
         ##use only off-diagonal (non-trivial) ranks:
         # inds = ~np.eye(X_ranks.shape[0],dtype=bool)
         # coeff, pval = spearmanr(X_ranks[inds], Z_ranks[inds])
-        return coeff
+        return self.rank_correlation_for_ks([k])[0]
 
     def kNN_graph(self, x, k):
         """  Implementation of a k nearest neighbor graph
@@ -238,30 +599,20 @@ class MeasureCalculator():
 
         return knn_idx
 
-    @measures.register(True)
+    @measures.register_for_ks("knn_recall")
+    def knn_recall_for_ks(self, ks):
+        ks = np.asarray(ks)
+        n = len(self.X)
+        return self.get_shared_neighbours()[ks] / (n * ks)
+
+    @measures.register(True, requires=("shared_neighbours",))
     def knn_recall(self, k):
         """     Computes the accuracy of k nearest neighbors between x and y.
-        :param x: array of positions for first dataset
-        :param y: array of positions for second dataset
         :param k: number of nearest neighbors considered
-        :param metric: Metric used for distances of x, must be a metric available for sklearn.metrics.pairwise_distances
-        :return: Share of x's k nearest neighbors that are also y's k nearest neighbors     """
-
-        metric = "euclidean"
+        :return: Share of the k nearest neighbors in Z that are also k nearest neighbors in X,
+                 from the cached neighbourhoods     """
 
-        x = torch.from_numpy(self.Z)
-        y = torch.from_numpy(self.X)
-
-        x_kNN = scipy.sparse.coo_matrix((np.ones(len(x) * k), (
-            np.repeat(np.arange(x.shape[0]), k), self.kNN_graph(x, k).numpy().flatten())),
-                                        shape=(len(x), len(x)))
-        y_kNN = scipy.sparse.coo_matrix(
-            (np.ones(len(y) * k), (np.repeat(np.arange(y.shape[0]), k), self.kNN_graph(y, k).numpy().flatten())),
-            shape=(len(y), len(y)))
-        overlap = x_kNN.multiply(y_kNN)
-        matched_kNNs = overlap.sum()
-
-        return matched_kNNs / (len(x) * k)
+        return self.knn_recall_for_ks([k])[0]
 
     @measures.register(False)
     def spearman_metric(self):
@@ -294,82 +645,169 @@ class MeasureCalculator():
 
         return spear_r
 
-    @measures.register(True)
+    @measures.register_for_ks("mrre")
+    def mrre_for_ks(self, ks):
+        X_ranks_of_Z, Z_ranks_of_X = self.get_gathered_ranks()
+        n, k_max = X_ranks_of_Z.shape
+        ks = np.asarray(ks)
+        # rank of the jth neighbour in its own space
+        j = np.arange(1, k_max + 1)
+
+        # First component goes from the latent space to the data space, i.e.
+        # the relative quality of neighbours in `Z`.
+        mrre_ZX = np.cumsum((np.abs(X_ranks_of_Z - j) / j).sum(axis=0))
+
+        # Second component goes from the data space to the latent space,
+        # i.e. the relative quality of neighbours in `X`.
+        # Note that this uses a different neighbourhood definition and normalisation factor!
+        mrre_XZ = np.cumsum((np.abs(Z_ranks_of_X - j) / j).sum(axis=0))
+
+        # Normalisation constant
+        C = n * np.cumsum(np.abs(2 * j - n - 1) / j)
+        return np.stack([mrre_ZX[ks - 1] / C[ks - 1], mrre_XZ[ks - 1] / C[ks - 1]], axis=1)
+
+    @measures.register(True, requires=("gathered_ranks",))
     def mrre(self, k):
         '''
         Calculates the mean relative rank error quality metric of the data
         space `X` with respect to the latent space `Z`, subject to its $k$
         nearest neighbours.
         '''
+        mrre_ZX, mrre_XZ = self.mrre_for_ks([k])[0]
+        return mrre_ZX, mrre_XZ
 
-        X_neighbourhood, X_ranks = self.get_X_neighbours_and_ranks(k)
-        Z_neighbourhood, Z_ranks = self.get_Z_neighbours_and_ranks(k)
-
-        n = self.pairwise_X.shape[0]
-
-        # First component goes from the latent space to the data space, i.e.
-        # the relative quality of neighbours in `Z`.
-
-        mrre_ZX = 0.0
-        for row in range(n):
-            for neighbour in Z_neighbourhood[row]:
-                rx = X_ranks[row, neighbour]
-                rz = Z_ranks[row, neighbour]
+    @staticmethod
+    def _knn_graph(points, n_neighbours, metrics=None):
+        """
+        Sparse, directed kNN graph of points. Edges are weighted with their Euclidean length, or with
+        their length in the mean of the metrics at both ends if metrics [n times d times d] is given.
+        """
+        n = points.shape[0]
+        n_neighbours = min(n_neighbours, n - 1)
+        distances, indices = NearestNeighbors(n_neighbors=n_neighbours + 1).fit(points).kneighbors(points)
+
+        rows = np.repeat(np.arange(n), n_neighbours)
+        cols = indices[:, 1:].ravel()
+        if metrics is None:
+            weights = distances[:, 1:].ravel()
+        else:
+            delta = points[cols] - points[rows]
+            G = (metrics[rows] + metrics[cols]) / 2
+            weights = np.sqrt(np.clip(np.einsum('ni, nij, nj -> n', delta, G, delta), 0, None))
+
+        # zero weights would be read as missing edges
+        weights = np.maximum(weights, np.finfo(float).tiny)
+        return scipy.sparse.csr_matrix((weights, (rows, cols)), shape=(n, n))
+
+    def _build_geodesics(self):
+        n = self.X.shape[0]
+        n_landmarks = self.n_landmarks
+        if n_landmarks is None or n_landmarks >= n:
+            landmarks = np.arange(n)
+        else:
+            landmarks = np.random.default_rng(self.seed).choice(n, n_landmarks, replace=False)
+
+        graph_X = self._knn_graph(self.X.reshape(n, -1), self.n_graph_neighbours)
+        graph_Z = self._knn_graph(self.Z.reshape(n, -1), self.n_graph_neighbours, self.metrics)
+        geodesics_X = dijkstra(graph_X, directed=False, indices=landmarks)
+        geodesics_Z = dijkstra(graph_Z, directed=False, indices=landmarks)
+
+        # ignore the landmarks themselves and pairs that are disconnected in either graph
+        mask = np.isfinite(geodesics_X) & np.isfinite(geodesics_Z)
+        mask[np.arange(len(landmarks)), landmarks] = False
+        return geodesics_X[mask], geodesics_Z[mask]
+
+    def _geodesic_distances(self):
+        """
+        Graph geodesic distances [n_landmarks times n] in data space (Euclidean kNN graph) and in latent
+        space (kNN graph weighted by the latent metrics), computed once with sparse Dijkstra.
+        """
+        return self._get("geodesics")
 
-                mrre_ZX += abs(rx - rz) / rz
+    @measures.register(False, requires=("geodesics",))
+    def geodesic_stress(self):
+        """
+        stress between the graph geodesic distances in input- and latent-space
+        """
+        geodesics_X, geodesics_Z = self._geodesic_distances()
+        sum_of_squared_differences = np.square(geodesics_X - geodesics_Z).sum()
+        sum_of_squares = np.square(geodesics_Z).sum()
 
-        # Second component goes from the data space to the latent space,
-        # i.e. the relative quality of neighbours in `X`.
+        return np.sqrt(sum_of_squared_differences / sum_of_squares)
 
-        mrre_XZ = 0.0
-        for row in range(n):
-            # Note that this uses a different neighbourhood definition!
-            for neighbour in X_neighbourhood[row]:
-                rx = X_ranks[row, neighbour]
-                rz = Z_ranks[row, neighbour]
+    @measures.register(False, requires=("geodesics",))
+    def geodesic_spearman(self):
+        """
+        spearman correlation between the graph geodesic distances in input- and latent-space
+        """
+        geodesics_X, geodesics_Z = self._geodesic_distances()
+        spear_r, _ = spearmanr(geodesics_X, geodesics_Z)
 
-                # Note that this uses a different normalisation factor
-                mrre_XZ += abs(rx - rz) / rx
+        return spear_r
 
-        # Normalisation constant
-        C = n * sum([abs(2 * j - n - 1) / j for j in range(1, k + 1)])
-        return mrre_ZX / C, mrre_XZ / C
+    def _densities(self, sigma):
+        """
+        normalised kernel density of every sample in X and in Z, on distances scaled to a maximum of 1.
+        The densities of all density_sigmas are computed together on first use and shared by the measures.
+        """
+        if ("densities", sigma) not in self._cache:
+            sigmas = sorted(set(self.density_sigmas) | {sigma})
+            for each_sigma, densities in zip(sigmas, self._build_densities(sigmas)):
+                self._cache["densities", each_sigma] = densities
+        return self._cache["densities", sigma]
 
-    @measures.register(False)
+    def _build_densities(self, sigmas):
+        """
+        densities for all sigmas from one streaming pass over the distances, in single precision and with
+        temporaries of block_size entries. The squared scaled distances of a block are shared by the sigmas.
+        """
+        n = len(self.X)
+        max_X, max_Z = self.get_max_distances()
+        scales = np.float32(1 / max_X ** 2), np.float32(1 / max_Z ** 2)
+        row_sums = np.zeros((len(sigmas), 2, n))
+
+        if self.knn_only:
+            start = 0
+            for distances_X, distances_Z in self._distance_blocks():
+                rows = slice(start, start + len(distances_X))
+                for space, distances in enumerate((distances_X, distances_Z)):
+                    squared = np.square(distances.astype(np.float32)) * scales[space]
+                    for i_sigma, sigma in enumerate(sigmas):
+                        kernel = np.exp(-squared / np.float32(sigma))
+                        row_sums[i_sigma, space, rows] = kernel.sum(axis=-1, dtype=np.float64)
+                start = rows.stop
+        else:
+            # each pair contributes to the rows of both its samples, the diagonal adds exp(0) to every row
+            row_sums += 1.
+            for start, end, rows, cols in self._condensed_chunks():
+                for space, condensed in enumerate(self._get("pairwise")):
+                    squared = np.square(condensed[start:end]) * scales[space]
+                    for i_sigma, sigma in enumerate(sigmas):
+                        kernel = np.exp(-squared / np.float32(sigma))
+                        row_sums[i_sigma, space] += np.bincount(rows, weights=kernel, minlength=n)
+                        row_sums[i_sigma, space] += np.bincount(cols, weights=kernel, minlength=n)
+
+        return [
+            (density_x / density_x.sum(axis=-1), density_z / density_z.sum(axis=-1))
+            for density_x, density_z in row_sums
+        ]
+
+    @measures.register(False, requires=("densities",))
     def density_global(self, sigma=0.1):
-        X = self.pairwise_X
-        X = X / X.max()
-        Z = self.pairwise_Z
-        Z = Z / Z.max()
-
-        density_x = np.sum(np.exp(-(X ** 2) / sigma), axis=-1)
-        density_x /= density_x.sum(axis=-1)
-
-        density_z = np.sum(np.exp(-(Z ** 2) / sigma), axis=-1)
-        density_z /= density_z.sum(axis=-1)
+        density_x, density_z = self._densities(sigma)
 
         return np.abs(density_x - density_z).sum()
 
     # @measures.register(False)
     def density_kl_global(self, sigma=0.1):
-        X = self.pairwise_X
-        X = X / X.max()
-        Z = self.pairwise_Z
-        Z = Z / Z.max()
-
-        density_x = np.sum(np.exp(-(X ** 2) / sigma), axis=-1)
-
-        density_x /= density_x.sum(axis=-1)
-
-        density_z = np.sum(np.exp(-(Z ** 2) / sigma), axis=-1)
-        density_z /= density_z.sum(axis=-1)
+        density_x, density_z = self._densities(sigma)
 
         return (density_x * (np.log(density_x) - np.log(density_z))).sum()
 
-    @measures.register(False)
+    @measures.register(False, requires=("densities",))
     def density_kl_global_100(self):
         return self.density_kl_global(100.)
 
-    @measures.register(False)
+    @measures.register(False, requires=("densities",))
     def density_kl_global_01(self):
         return self.density_kl_global(0.1)
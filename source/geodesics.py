@@ -1,72 +1,130 @@
-import numpy as np
-from scipy.integrate import solve_ivp
-from scipy.linalg import inv, kron
+import torch
+import functorch
 
-from geometry import get_pullbacked_Riemannian_metric, jacobian_decoder_jvp_parallel
-
-
-# Define the function M(gamma)
-def M(gamma):
-    # Placeholder: User must provide the actual implementation
-    return np.eye(len(gamma))
-
-
-# Define the function dM(gamma)
-def dM(gamma):
-    # Placeholder: User must provide the actual implementation
-    # This should return a matrix composed of matrices, i.e., a 3D array
-    return np.zeros((len(gamma), len(gamma), len(gamma)))
+from geometry import get_pullbacked_Riemannian_metric
+from utils import smallmat
 
 
 class GeodesicSolver:
+    """
+    Batched geodesics of the pullback metric G(z) = J^T J of the decoder of an AE.
+    All methods work on batches of curves, shape (batch_size, z_dim) for points and velocities.
+    """
+
     def __init__(self, model):
         self.model = model
 
-    def solve(self, gamma_0, gamma_dot_0, t_span):
-        # Initial conditions
-        initial_conditions = np.concatenate((gamma_0, gamma_dot_0))
-
-        # Solve the ODE
-        solution = solve_ivp(
-            self.geodesic_ode,
-            t_span,
-            initial_conditions,
-            method="RK45",
-            t_eval=np.linspace(t_span[0], t_span[1], 100),
-        )
-
-        # The solution object contains the trajectory and its derivatives
-        gamma_trajectory = solution.y[:2]
-        gamma_dot_trajectory = solution.y[2:]
-
-        return gamma_trajectory, gamma_dot_trajectory
-
-    def geodesic_ode(self, t, y):
-        # Split y into gamma and gamma_dot
-        dim = len(y) // 2
-        gamma, gamma_dot = y[:dim], y[dim:]
-
-        M = get_pullbacked_Riemannian_metric(self.model.decode, gamma)
-
-        def get_metric(z):
-            return get_pullbacked_Riemannian_metric(self.model.decode, z)
-
-        def get_flattened_metric(z):
-            M = get_metric(z)
-            return M.T.flatten()
-
-        M = get_metric(gamma)
-
-        # calculate gradient of M w.r.t. gamma
-        dM = jacobian_decoder_jvp_parallel(get_metric, gamma, v=None)
-
-        dM_flattened = jacobian_decoder_jvp_parallel(
-            get_flattened_metric, gamma, v=None
-        )
-
-        # Compute the right-hand side of the ODE
-        gamma_ddot = (
-            -0.5 * np.inv(M) @ (2 * dM - dM_flattened) @ np.kron(gamma_dot, gamma_dot)
+    def immersion(self, z):
+        x = self.model.decode(z)
+        return x.view(x.shape[0], -1)
+
+    def metric(self, z):
+        return get_pullbacked_Riemannian_metric(self.model.decode, z)
+
+    def christoffel_symbols(self, z):
+        """
+        Christoffel symbols of the second kind, Gamma[n, k, i, j] = Gamma^k_ij at z[n]
+        """
+        def metric_at(z_single):
+            return self.metric(z_single.unsqueeze(0))[0]
+
+        G = self.metric(z)
+        # dG[n, i, j, l] = d_l G_ij
+        dG = functorch.vmap(functorch.jacfwd(metric_at))(z)
+
+        # d_i G_lj + d_j G_li - d_l G_ij, indexed [n, l, i, j]
+        term = (
+            torch.einsum("nlji -> nlij", dG)
+            + dG
+            - torch.einsum("nijl -> nlij", dG)
         )
-        # Return the derivatives
-        return np.concatenate((gamma_dot, gamma_ddot))
+        return 0.5 * torch.einsum("nkl, nlij -> nkij", smallmat.inv(G), term)
+
+    def acceleration(self, z, v):
+        """
+        second derivative of a geodesic through z with velocity v
+        """
+        return -torch.einsum("nkij, ni, nj -> nk", self.christoffel_symbols(z), v, v)
+
+    @torch.no_grad()
+    def shoot(self, z0, v0, t_end=1.0, n_steps=100):
+        """
+        Solve the initial value problem with a fixed step RK4 integrator, for all curves at once.
+        :param z0: starting points
+        :param v0: initial velocities
+        :return: points and velocities along the geodesics, both of shape (n_steps + 1, batch_size, z_dim)
+        """
+        h = t_end / n_steps
+        z, v = z0, v0
+        zs, vs = [z], [v]
+
+        def rhs(z, v):
+            return v, self.acceleration(z, v)
+
+        for _ in range(n_steps):
+            k1_z, k1_v = rhs(z, v)
+            k2_z, k2_v = rhs(z + h / 2 * k1_z, v + h / 2 * k1_v)
+            k3_z, k3_v = rhs(z + h / 2 * k2_z, v + h / 2 * k2_v)
+            k4_z, k4_v = rhs(z + h * k3_z, v + h * k3_v)
+            z = z + h / 6 * (k1_z + 2 * k2_z + 2 * k3_z + k4_z)
+            v = v + h / 6 * (k1_v + 2 * k2_v + 2 * k3_v + k4_v)
+            zs.append(z)
+            vs.append(v)
+
+        return torch.stack(zs), torch.stack(vs)
+
+    def energy(self, curves):
+        """
+        discrete energy of curves of shape (batch_size, n_points, z_dim), measured in data space.
+        For fine discretizations this is the energy w.r.t. the pullback metric.
+        """
+        bs, n_points, z_dim = curves.shape
+        x = self.immersion(curves.reshape(-1, z_dim)).view(bs, n_points, -1)
+        return (n_points - 1) * torch.sum((x[:, 1:] - x[:, :-1]) ** 2, dim=(1, 2))
+
+    def length(self, curves):
+        """
+        discrete length of curves of shape (batch_size, n_points, z_dim), measured in data space
+        """
+        bs, n_points, z_dim = curves.shape
+        x = self.immersion(curves.reshape(-1, z_dim)).view(bs, n_points, -1)
+        return torch.linalg.norm(x[:, 1:] - x[:, :-1], dim=2).sum(dim=1)
+
+    def solve_bvp(self, z0, z1, n_points=20, n_iter=500, lr=1.0e-2):
+        """
+        Solve the boundary value problem by minimizing the discrete curve energy, for all curves at once.
+        The curves are initialized as straight lines in the latent space.
+        :param z0: starting points
+        :param z1: end points
+        :return: curves of shape (batch_size, n_points, z_dim)
+        """
+        z0, z1 = z0.detach(), z1.detach()
+        t = torch.linspace(0, 1, n_points).to(z0)[None, :, None]
+        line = (1 - t) * z0.unsqueeze(1) + t * z1.unsqueeze(1)
+        interior = line[:, 1:-1].clone().requires_grad_(True)
+
+        optimizer = torch.optim.Adam([interior], lr=lr)
+        for _ in range(n_iter):
+            optimizer.zero_grad()
+            curves = torch.cat([z0.unsqueeze(1), interior, z1.unsqueeze(1)], dim=1)
+            # the curves are independent, so the gradient of the summed energy is the one of each curve
+            energy = self.energy(curves).sum()
+            # only the curves are optimized, the gradients of the model parameters are left untouched
+            interior.grad = torch.autograd.grad(energy, interior)[0]
+            optimizer.step()
+
+        return torch.cat([z0.unsqueeze(1), interior.detach(), z1.unsqueeze(1)], dim=1)
+
+    def interpolate(self, z0, z1, n_points=20, **kwargs):
+        """
+        geodesic interpolation between z0 and z1, see solve_bvp
+        """
+        return self.solve_bvp(z0, z1, n_points=n_points, **kwargs)
+
+    def distance(self, z0, z1, n_points=20, **kwargs):
+        """
+        geodesic distances between z0 and z1 (length of the energy minimizing curves)
+        """
+        curves = self.solve_bvp(z0, z1, n_points=n_points, **kwargs)
+        with torch.no_grad():
+            return self.length(curves)
@@ -1,30 +1,48 @@
 import torch
+import torch.nn as nn
 import copy
+import math
+from concurrent.futures import ThreadPoolExecutor
 
 from utils.utils import batch_jacobian
+from utils import smallmat
 from utils.config import Config
 
 config = Config()
 
 
-def relaxed_distortion_measure(func, z, eta=0.2, metric='identity', create_graph=True, reg="iso"):
+def relaxed_distortion_measure(func, z, eta=0.2, metric='identity', create_graph=True, reg="iso",
+                               n_probes=1, probe="gaussian", linearization=None, exact_dim=None):
+    """
+    linearization: as returned by linearize. The regularizer is then evaluated at its points (z and eta are
+    ignored) and reuses its graph instead of running func again.
+    exact_dim: if the output of func has at most exact_dim dimensions, Tr(G) and Tr(G^2) are computed exactly
+    from the jacobian (one batched vjp per output dimension) instead of the stochastic estimates.
+    """
     if metric == 'identity':
-        bs = len(z)
-        z_perm = z[torch.randperm(bs)]
-        if eta is not None:
-            alpha = (torch.rand(bs) * (1 + 2*eta) - eta).unsqueeze(1).to(z)
-            z_augmented = alpha*z + (1-alpha)*z_perm
+        if linearization is not None:
+            inputs, _, rows = linearization
+            z_augmented = inputs if rows is None else inputs[rows]
+        elif eta is not None:
+            z_augmented = mixup(z, eta)
         else:
             z_augmented = z
+        bs = len(z_augmented)
             
-        if reg in ["iso", "conf", "conf-log"]:
-            v = torch.randn(z.size()).to(z)
-            Jv = torch.autograd.functional.jvp(
-                func, z_augmented, v=v, create_graph=create_graph)[1]
-            TrG = torch.sum(Jv.view(bs, -1)**2, dim=1)
-            JTJv = (torch.autograd.functional.vjp(func, z_augmented,
-                    v=Jv, create_graph=create_graph)[1]).view(bs, -1)
-            TrG2 = torch.sum(JTJv**2, dim=1)
+        if reg in ["iso", "conf", "conf-log", "conf-log-inside"]:
+            if linearization is None:
+                linearization = forward_with_grad(func, z_augmented)
+
+            if exact_dim is not None and get_output_dim(linearization) <= exact_dim:
+                J = jacobian_from_vjps(linearization, create_graph=create_graph)
+                TrG, TrG2 = gram_traces(J)
+            else:
+                v = sample_probes(n_probes, z_augmented, probe)
+                Jv, JTJv = batched_jvp_vjp(
+                    func, z_augmented, v, create_graph=create_graph, linearization=linearization)
+                # Hutchinson estimates of Tr(G) and Tr(G^2), averaged over the probes
+                TrG = torch.sum(Jv.view(n_probes, bs, -1)**2, dim=2).mean(0)
+                TrG2 = torch.sum(JTJv.view(n_probes, bs, -1)**2, dim=2).mean(0)
             if reg == "iso":
                 return TrG2.mean()/(TrG**2).mean()
             elif reg == "conf":
@@ -38,35 +56,290 @@ def relaxed_distortion_measure(func, z, eta=0.2, metric='identity', create_graph
             else:
                 raise NotImplementedError
         elif reg in ["conf-noapprox"]:
-            J = jacobian_parallel(func, z_augmented)
-            JTJ = torch.einsum('nij, nik -> njk', J, J)
-            TrG2 = torch.einsum('nii -> n', JTJ@JTJ)
-            TrG = torch.einsum('nii -> n', JTJ)
+            if linearization is not None:
+                J = jacobian_from_vjps(linearization, create_graph=create_graph)
+            else:
+                J = jacobian_parallel(func, z_augmented, create_graph=create_graph)
+            TrG, TrG2 = gram_traces(J)
             if reg == "conf-noapprox":
                 return (TrG2/torch.clip(TrG**2, min=1.0e-6)).mean()
     else:
         raise NotImplementedError
 
 
-def get_flattening_scores(G, mode='condition_number'):
-    if mode == 'condition_number':
-        S = torch.svd(G).S
-        scores = 1 - S.min(1).values/S.max(1).values  # inverted condition number -1
-    elif mode == 'variance':
-        G_mean = torch.mean(G, dim=0, keepdim=True)
-        A = torch.inverse(G_mean)@G
-        scores = torch.sqrt(torch.sum(torch.abs(torch.log(torch.svd(A).S)), dim=1))  # **2
-    elif mode == 'volume_preserving':
-        logdetG = torch.log(torch.clip(torch.det(G), min=1.0e-8))
-        # mean = torch.median(logdetG, dim=0, keepdim=True).values
-        mean = torch.mean(logdetG, dim=0, keepdim=True)
-        scores = torch.sqrt(torch.abs((logdetG - mean)))
+def sample_probes(n_probes, z, probe="gaussian"):
+    """
+    n_probes random probe vectors per sample, of shape (n_probes, *z.shape)
+    :param probe: 'gaussian' or 'rademacher'
+    """
+    shape = (n_probes,) + tuple(z.size())
+    if probe == "gaussian":
+        return torch.randn(shape).to(z)
+    elif probe == "rademacher":
+        return (torch.randint(0, 2, shape) * 2 - 1).to(z)
     else:
-        pass
-    return scores
+        raise NotImplementedError
+
+
+def mixup(x, eta):
+    """
+    random interpolations (and slight extrapolations, controlled by eta) between the samples of x
+    """
+    bs = len(x)
+    x_perm = x[torch.randperm(bs)]
+    alpha = (torch.rand(bs) * (1 + 2*eta) - eta).to(x).view(bs, *([1] * (x.dim() - 1)))
+    return alpha*x + (1-alpha)*x_perm
+
+
+def linearize(func, x, eta=None):
+    """
+    Run func once, for the training forward pass and for a geometric regularizer.
+    The inputs are made to require grad, so the regularizer can take jacobian vector products from the graph
+    of this forward pass. If eta is given, the regularizer points are mixup(x, eta), which are evaluated in
+    the same call, concatenated to x.
+    :return: z = func(x) and the linearization (inputs, out, rows), where out = func(inputs) and rows
+        selects the regularizer points (None for all of them)
+    """
+    bs = len(x)
+    if eta is None:
+        inputs = x.detach().requires_grad_(True)
+        out = func(inputs)
+        return out, (inputs, out, None)
+
+    inputs = torch.cat([x, mixup(x, eta)]).detach().requires_grad_(True)
+    out = func(inputs)
+    return out[:bs], (inputs, out, slice(bs, None))
+
+
+def forward_with_grad(func, inputs):
+    """
+    Evaluate func at inputs that require grad, in the (inputs, out, rows) format of linearize
+    """
+    if inputs.requires_grad:
+        inputs = inputs.view_as(inputs)
+    else:
+        inputs = inputs.detach().requires_grad_(True)
+    return inputs, func(inputs), None
+
+
+def get_output_dim(linearization):
+    inputs, out, _ = linearization
+    return out.numel() // len(inputs)
+
+
+def jacobian_from_vjps(linearization, create_graph=True):
+    """
+    Jacobian at the regularizer points of a linearization, from one batched vjp per output dimension.
+    Cheap if the output (e.g. the latent space) is low dimensional.
+    :return: jacobian of shape (batch_size, out_dim, in_dim)
+    """
+    inputs, out, rows = linearization
+    if rows is not None:
+        out = out[rows]
+    bs = len(inputs) if rows is None else len(inputs[rows])
+    out_dim = out.numel() // bs
+
+    # the k-th cotangent is the k-th unit vector for every sample
+    E = torch.eye(out_dim).to(out).unsqueeze(1).expand(out_dim, bs, out_dim).reshape(out_dim, *out.shape)
+    J = torch.autograd.grad(
+        out, inputs, E, create_graph=create_graph, retain_graph=True, is_grads_batched=True)[0]
+    if rows is not None:
+        J = J[:, rows]
+    return J.reshape(out_dim, bs, -1).transpose(0, 1)
+
+
+def get_gram(J):
+    """
+    Gram matrix of the batch of jacobians J on its smaller side, i.e. J J^T if J has fewer rows than
+    columns and J^T J otherwise. Both have the same nonzero spectrum, so traces and nonzero eigenvalues
+    of the (pullback) metric J^T J can be taken from the smaller one.
+    """
+    if J.shape[1] <= J.shape[2]:
+        return torch.einsum('nij, nkj -> nik', J, J)
+    return torch.einsum('nij, nik -> njk', J, J)
+
+
+def gram_traces(J):
+    """
+    Tr(G) and Tr(G^2) of G = J^T J, computed on the smaller Gram side
+    """
+    G = get_gram(J)
+    TrG = torch.einsum('nii -> n', G)
+    # G is symmetric, so Tr(G^2) is the sum of its squared entries
+    TrG2 = torch.sum(G**2, dim=(1, 2))
+    return TrG, TrG2
+
+
+def batched_jvp_vjp(func, inputs, v, create_graph=True, linearization=None):
+    """
+    J v and J^T J v for a batch of probes v of shape (n_probes, *inputs.shape), where J is the jacobian
+    of func at inputs. func is evaluated once (or not at all if a linearization from linearize is given),
+    the probes are handled as one batched (vmapped) backward pass each.
+    J v is obtained as the vjp of the (linear) vjp map u -> J^T u.
+    :return: J v of shape (n_probes, *func(inputs).shape) and J^T J v of shape (n_probes, *inputs.shape)
+    """
+    if linearization is None:
+        linearization = forward_with_grad(func, inputs)
+    inputs, out, rows = linearization
+    if rows is not None:
+        out = out[rows]
+
+    u = torch.zeros_like(out, requires_grad=True)
+    JTu = torch.autograd.grad(out, inputs, u, create_graph=True)[0]
+    if rows is not None:
+        JTu = JTu[rows]
+    Jv = torch.autograd.grad(
+        JTu, u, v, create_graph=create_graph, retain_graph=True, is_grads_batched=True)[0]
+    # the graph of a linearization is still needed by the training loss
+    JTJv = torch.autograd.grad(
+        out, inputs, Jv, create_graph=create_graph, retain_graph=True, is_grads_batched=True)[0]
+    if rows is not None:
+        JTJv = JTJv[:, rows]
+    return Jv, JTJv
+
+
+def stochastic_logdet(linearization, n_probes=1, n_steps=10, probe="gaussian"):
+    """
+    Jacobian free estimate of logdet(J J^T) at the regularizer points of a linearization (see linearize),
+    with J the jacobian of func, e.g. the logdet of the pushforward metric of the encoder.
+    The value is a stochastic Lanczos quadrature estimate, which only needs the products
+    J J^T v = jvp(vjp(v)) from the graph of the forward pass. Its gradient is the Hutchinson estimate
+    of Tr(G^-1 dG) = E[(G^-1 v)^T dG v], with G^-1 v taken from the same Lanczos decomposition.
+    :param n_steps: number of Lanczos steps (at most the output dimension of func)
+    :return: logdet estimate per regularizer point, differentiable w.r.t. the parameters of func
+    """
+    inputs, out, rows = linearization
+    if rows is not None:
+        out = out[rows]
+    bs = len(inputs) if rows is None else len(inputs[rows])
+    out_shape = out.shape
+    out_dim = out.numel() // bs
+    n_steps = min(n_steps, out_dim)
+
+    def vjp(v, create_graph=False):
+        JTv = torch.autograd.grad(
+            out, inputs, v.reshape(n_probes, *out_shape), create_graph=create_graph, retain_graph=True,
+            is_grads_batched=True)[0]
+        if rows is not None:
+            JTv = JTv[:, rows]
+        return JTv
+
+    # J a is the vjp of the linear map u -> J^T u
+    u = torch.zeros_like(out, requires_grad=True)
+    JTu = torch.autograd.grad(out, inputs, u, create_graph=True)[0]
+    if rows is not None:
+        JTu = JTu[rows]
+
+    def matvec(v):
+        JTv = vjp(v).detach()
+        JJTv = torch.autograd.grad(JTu, u, JTv, retain_graph=True, is_grads_batched=True)[0]
+        return JJTv.reshape(n_probes, bs, out_dim).detach()
+
+    v = sample_probes(n_probes, out.new_zeros(bs, out_dim), probe)
+    v_norm = torch.linalg.norm(v, dim=2, keepdim=True)
+
+    # batched Lanczos with full reorthogonalization, one run per probe and point
+    Q = []
+    alphas = []
+    betas = []
+    q = v / v_norm
+    q_prev = torch.zeros_like(q)
+    beta = torch.zeros_like(v_norm)
+    for _ in range(n_steps):
+        Q.append(q)
+        w = matvec(q)
+        alpha = torch.sum(q * w, dim=2, keepdim=True)
+        w = w - alpha * q - beta * q_prev
+        for q_j in Q:
+            w = w - torch.sum(q_j * w, dim=2, keepdim=True) * q_j
+        alphas.append(alpha)
+        q_prev = q
+        beta = torch.linalg.norm(w, dim=2, keepdim=True)
+        betas.append(beta)
+        q = w / torch.clip(beta, min=1.0e-12)
+    Q = torch.stack(Q, dim=3)  # (n_probes, bs, out_dim, n_steps)
+
+    T = torch.diag_embed(torch.cat(alphas, dim=2))
+    if n_steps > 1:
+        off_diagonal = torch.cat(betas[:-1], dim=2)
+        T = T + torch.diag_embed(off_diagonal, offset=1) + torch.diag_embed(off_diagonal, offset=-1)
+    theta, S = torch.linalg.eigh(T)
+    theta = torch.clip(theta, min=1.0e-12)
+
+    # v^T log(G) v ~ |v|^2 e1^T log(T) e1
+    tau = S[..., 0, :]
+    logdet = (v_norm.squeeze(2) ** 2 * torch.sum(tau ** 2 * torch.log(theta), dim=2)).mean(0)
+
+    # G^-1 v ~ |v| Q T^-1 e1, then (G^-1 v)^T dG v = d(J^T G^-1 v)^T (J^T v) has the gradient we want
+    Ginv_v = v_norm * torch.einsum('pnik, pnk -> pni', Q, torch.einsum('pnjk, pnk -> pnj', S, tau / theta))
+    JTv = vjp(v, create_graph=True).reshape(n_probes, bs, -1)
+    JTGinv_v = vjp(Ginv_v, create_graph=True).reshape(n_probes, bs, -1)
+    surrogate = torch.sum(JTv * JTGinv_v, dim=2).mean(0)
+
+    return logdet + surrogate - surrogate.detach()
+
+
+def get_metric_spectrum(G):
+    """
+    Singular values of the batch of symmetric metrics G, from a symmetric eigendecomposition
+    """
+    return smallmat.eigvalsh(G).abs()
+
+
+def get_all_flattening_scores(G, S=None):
+    """
+    All flattening scores of G from one symmetric eigendecomposition (plus one for the variance
+    score, which depends on G relative to the mean metric).
+    :param S: singular values of G if they are already known, see get_metric_spectrum
+    :return: dict with the condition_number, variance and volume_preserving scores and the logdet of G
+    """
+    if S is None:
+        S = get_metric_spectrum(G)
+
+    # inverted condition number -1
+    condition_number = 1 - S.min(1).values / S.max(1).values
+
+    # singular values of A = G_mean^-1 G are the square roots of the eigenvalues of A^T A
+    G_mean = torch.mean(G, dim=0, keepdim=True)
+    A = smallmat.inv(G_mean) @ G
+    logS_A = 0.5 * torch.log(get_metric_spectrum(A.transpose(1, 2) @ A))
+    variance = torch.sqrt(torch.sum(torch.abs(logS_A), dim=1))  # **2
 
+    logdetG = torch.sum(torch.log(S), dim=1)
+    logdetG_clipped = torch.clip(logdetG, min=math.log(1.0e-8))
+    # mean = torch.median(logdetG, dim=0, keepdim=True).values
+    mean = torch.mean(logdetG_clipped, dim=0, keepdim=True)
+    volume_preserving = torch.sqrt(torch.abs((logdetG_clipped - mean)))
+
+    return {
+        "condition_number": condition_number,
+        "variance": variance,
+        "volume_preserving": volume_preserving,
+        "logdet": logdetG,
+    }
+
+
+def get_flattening_scores(G, mode='condition_number'):
+    return get_all_flattening_scores(G)[mode]
+
+
+def jacobian_parallel(func, inputs, v=None, create_graph=True, mode="rev",
+                      chunk_size=None, memory_budget=None, n_threads=1, out=None, return_output=False):
+    """
+    Batched jacobian of func, of shape (batch_size, out_dim, in_dim).
+    If chunk_size or memory_budget (in bytes) is given, the inputs are streamed through in chunks,
+    see map_chunks for n_threads and out.
+    If return_output (not together with chunking), the flattened output func(inputs) of shape
+    (batch_size, out_dim) from the same forward pass is returned as well.
+    """
+    if chunk_size is not None or memory_budget is not None or out is not None:
+        if chunk_size is None:
+            chunk_size = get_chunk_size(func, inputs, memory_budget)
+        return map_chunks(
+            lambda chunk: jacobian_parallel(func, chunk, v=v, create_graph=create_graph, mode=mode),
+            inputs, chunk_size, n_threads=n_threads, out=out,
+        )
 
-def jacobian_parallel(func, inputs, v=None, create_graph=True, mode="rev"):
     #batch_size, z_dim = inputs.size()
     #if v is None:
     #    v = torch.eye(z_dim).unsqueeze(0).repeat(
@@ -82,17 +355,160 @@ def jacobian_parallel(func, inputs, v=None, create_graph=True, mode="rev"):
     # J = torch.autograd.functional.jacobian(func, inputs, create_graph=True, strict=True, vectorize=False)
     # return J
 
+    net = get_fc_net(func)
+    if net is not None and net[0].in_features == inputs[0].numel():
+        # plain Linear + pointwise activation stacks have a closed form jacobian
+        return fc_jacobian(net, inputs.view(inputs.shape[0], -1), return_output=return_output)
+
     def flattened_immersion(x):
         recon = func(x)
         recon = recon.view(recon.shape[0], -1)
         return recon
 
-    J = batch_jacobian(flattened_immersion, inputs, mode).squeeze()
+    if return_output:
+        J, recon = batch_jacobian(lambda x: (flattened_immersion(x),) * 2, inputs, mode, has_aux=True)
+        J = J.reshape(inputs.shape[0], -1, inputs[0].numel())
+        return J, recon.reshape(inputs.shape[0], -1)
+
+    J = batch_jacobian(flattened_immersion, inputs, mode)
+    J = J.reshape(inputs.shape[0], -1, inputs[0].numel())
+
+    return J
+
+
+_SELU_ALPHA = 1.6732632423543772848170429916717
+_SELU_SCALE = 1.0507009873554804934193349852946
+
+_POINTWISE_ACTIVATIONS = (
+    nn.ReLU,
+    nn.LeakyReLU,
+    nn.Sigmoid,
+    nn.Tanh,
+    nn.Softplus,
+    nn.ELU,
+    nn.SELU,
+)
+
+
+def activation_derivative(act, h):
+    """
+    Derivative of a pointwise activation module evaluated at the pre-activation h
+    :param act: activation module (one of _POINTWISE_ACTIVATIONS)
+    :param h: pre-activation of shape (batch_size, dim)
+    :return: diagonal of the activation jacobian, same shape as h
+    """
+    if isinstance(act, nn.ReLU):
+        return (h > 0).to(h)
+    elif isinstance(act, nn.LeakyReLU):
+        return torch.where(h > 0, torch.ones_like(h), torch.full_like(h, act.negative_slope))
+    elif isinstance(act, nn.Sigmoid):
+        s = torch.sigmoid(h)
+        return s * (1 - s)
+    elif isinstance(act, nn.Tanh):
+        return 1 - torch.tanh(h) ** 2
+    elif isinstance(act, nn.Softplus):
+        return torch.where(h * act.beta > act.threshold, torch.ones_like(h), torch.sigmoid(act.beta * h))
+    elif isinstance(act, nn.ELU):
+        # clamp so that the unused branch of torch.where can not produce inf gradients
+        return torch.where(h > 0, torch.ones_like(h), act.alpha * torch.exp(torch.clamp(h, max=0)))
+    elif isinstance(act, nn.SELU):
+        return _SELU_SCALE * torch.where(h > 0, torch.ones_like(h), _SELU_ALPHA * torch.exp(torch.clamp(h, max=0)))
+    else:
+        raise NotImplementedError
+
+
+def get_fc_net(func):
+    """
+    Find the Linear + pointwise activation stack behind func, if there is one.
+    func is either such a network (FC_vec, FC_image) or the encode/decode method of an AE
+    built from one. Returns None if the jacobian has to be computed via autodiff.
+    """
+    if getattr(func, "__func__", None) is not None:
+        qualname = func.__func__.__qualname__
+        if qualname == "AE.encode":
+            func = func.__self__.encoder
+        elif qualname == "AE.decode":
+            func = func.__self__.decoder
+        else:
+            return None
+
+    net = getattr(func, "net", None)
+    if not isinstance(net, nn.Sequential):
+        return None
+    if not isinstance(net[0], nn.Linear):
+        return None
+    for layer in net:
+        if not isinstance(layer, (nn.Linear,) + _POINTWISE_ACTIVATIONS):
+            return None
 
+    return net
+
+
+def fc_jacobian(net, inputs, return_output=False):
+    """
+    Layer-wise jacobian of a Linear + pointwise activation stack.
+    Propagates the jacobian through the layers as weight matrices times activation derivatives,
+    starting from the smaller of the input and output side.
+    :param net: nn.Sequential as returned by get_fc_net
+    :param inputs: flattened inputs of shape (batch_size, in_dim)
+    :param return_output: also return the output net(inputs) of the same forward pass
+    :return: jacobian of shape (batch_size, out_dim, in_dim)
+    """
+    bs = inputs.shape[0]
+    in_dim = inputs.shape[1]
+    out_dim = [layer for layer in net if isinstance(layer, nn.Linear)][-1].out_features
+
+    if in_dim <= out_dim:
+        # forward mode: push d(h)/d(input) through the net
+        h = inputs
+        J = None
+        for layer in net:
+            if isinstance(layer, nn.Linear):
+                h = layer(h)
+                if J is None:
+                    J = layer.weight.unsqueeze(0).expand(bs, -1, -1)
+                else:
+                    J = torch.einsum("oi, nij -> noj", layer.weight, J)
+            else:
+                J = activation_derivative(layer, h).unsqueeze(2) * J
+                h = layer(h)
+        if return_output:
+            return J, h
+        return J
+
+    # reverse mode: store the factors in a forward pass, then pull d(output)/d(h) back through the net
+    h = inputs
+    factors = []
+    for layer in net:
+        if isinstance(layer, nn.Linear):
+            h = layer(h)
+            factors.append(("linear", layer.weight))
+        else:
+            factors.append(("act", activation_derivative(layer, h)))
+            h = layer(h)
+
+    J = None
+    for kind, factor in reversed(factors):
+        if kind == "linear":
+            if J is None:
+                J = factor.unsqueeze(0).expand(bs, -1, -1)
+            else:
+                J = torch.einsum("noi, ij -> noj", J, factor)
+        else:
+            if J is None:
+                J = torch.diag_embed(factor)
+            else:
+                J = J * factor.unsqueeze(1)
+    if return_output:
+        return J, h
     return J
 
 
-def get_pushforwarded_Riemannian_metric(func, z):
+def get_pushforwarded_Riemannian_metric(func, z, return_output=False):
+    if return_output:
+        J, out = jacobian_parallel(func, z, v=None, mode="rev", return_output=True)
+        G = torch.einsum('nij, nkj->nik', J, J)
+        return G, out
     J = jacobian_parallel(func, z, v=None, mode="rev")
     G = torch.einsum('nij, nkj->nik', J, J)
     return G
@@ -104,7 +520,13 @@ def get_pullbacked_Riemannian_metric(func, z, mode="fwd"):
     return G
 
 
-def get_Riemannian_metric(func, z, purpose, purpose_part=None):
+def get_Riemannian_metric(func, z, purpose, purpose_part=None,
+                          chunk_size=None, memory_budget=None, n_threads=1, out=None):
+    """
+    Riemannian metric of the encoder (pushforward) or decoder (pullback) at the points z.
+    If chunk_size or memory_budget (in bytes) is given, the points are streamed through in chunks,
+    see map_chunks for n_threads and out.
+    """
     if purpose not in ["vis", "reg"]:
         raise NotImplementedError
     
@@ -112,8 +534,57 @@ def get_Riemannian_metric(func, z, purpose, purpose_part=None):
         purpose_part = config["part_of_ae"][purpose]
 
     if purpose_part == "encoder":
-        return get_pushforwarded_Riemannian_metric(func, z)
+        metric_fn = get_pushforwarded_Riemannian_metric
     elif purpose_part == "decoder":
-        return get_pullbacked_Riemannian_metric(func, z)
+        metric_fn = get_pullbacked_Riemannian_metric
     else:
         raise NotImplementedError
+
+    if chunk_size is None and memory_budget is None and out is None:
+        return metric_fn(func, z)
+
+    if chunk_size is None:
+        chunk_size = get_chunk_size(func, z, memory_budget)
+    return map_chunks(lambda chunk: metric_fn(func, chunk), z, chunk_size, n_threads=n_threads, out=out)
+
+
+# rough number of jacobian sized temporaries alive while computing the jacobian of one point
+_JACOBIAN_MEMORY_FACTOR = 4
+
+
+def get_chunk_size(func, inputs, memory_budget):
+    """
+    Largest number of points whose jacobians fit into memory_budget bytes
+    """
+    with torch.no_grad():
+        out_dim = func(inputs[:1]).numel()
+    bytes_per_point = _JACOBIAN_MEMORY_FACTOR * out_dim * inputs[0].numel() * inputs.element_size()
+    return max(1, int(memory_budget // bytes_per_point))
+
+
+def map_chunks(fn, inputs, chunk_size, n_threads=1, out=None):
+    """
+    Apply fn to consecutive chunks of inputs and stack the results along the first dimension.
+    :param n_threads: number of threads the chunks are distributed over
+    :param out: preallocated (or memory-mapped, e.g. torch.from_numpy(np.memmap(...))) tensor the results
+        are written to. Results written to out are detached, so this is meant for evaluation only.
+    :return: the stacked results, or out
+    """
+    def run(start):
+        result = fn(inputs[start:start + chunk_size])
+        if out is None:
+            return result
+        with torch.no_grad():
+            out[start:start + len(result)] = result.to(out)
+        return None
+
+    starts = range(0, len(inputs), chunk_size)
+    if n_threads > 1:
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            results = list(pool.map(run, starts))
+    else:
+        results = [run(start) for start in starts]
+
+    if out is not None:
+        return out
+    return torch.cat(results)
@@ -24,6 +24,8 @@ class EARTH(CustomDataset):
         self.n_samples -= torch.sum(self.labels == 6).item()
         self.targets = self.targets[self.labels != 6]
         self.labels = self.labels[self.labels != 6]
+        # __getitem__ indexes self.dataset, it has to hold the same samples as self.data
+        self.dataset = self.data
 
         # print(f"EARTH split {split} | {self.data.size()}")
 
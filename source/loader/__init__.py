@@ -6,14 +6,46 @@ from loader.POLSURF_dataset import POLSURF
 from loader.ZILIONIS_dataset import ZILIONIS
 from loader.CELEGANS_dataset import CELEGANS
 from loader.PBMC_dataset import PBMC
+from loader.tensor_loader import TensorLoader
 
-def get_dataloader(data_dict, **kwargs):
+def get_dataloader(data_dict, device=None, rank=0, world_size=1, seed=0, **kwargs):
+    """
+    :param rank, world_size: shard the batches over world_size data-parallel processes, rank is this process
+    :param seed: seed of the shuffling shared by all ranks, only used if world_size > 1
+    """
     dataset = get_dataset(data_dict)
-    loader = data.DataLoader(
-        dataset,
-        batch_size=data_dict["batch_size"],
-        shuffle=data_dict.get("shuffle", True)
-    )
+    n_workers = data_dict.get("n_workers", 0)
+    shuffle = data_dict.get("shuffle", True)
+    if data_dict.get("tensor_loader", True) and TensorLoader.supports(dataset):
+        loader = TensorLoader(
+            dataset,
+            batch_size=data_dict["batch_size"],
+            shuffle=shuffle,
+            device=device,
+            n_workers=n_workers,
+            rank=rank,
+            world_size=world_size,
+            seed=seed,
+        )
+    elif world_size > 1:
+        # the sampler shards the samples, the batch size is per rank
+        sampler = data.distributed.DistributedSampler(
+            dataset, num_replicas=world_size, rank=rank, shuffle=shuffle, seed=seed, drop_last=True
+        )
+        loader = data.DataLoader(
+            dataset,
+            batch_size=data_dict["batch_size"] // world_size,
+            sampler=sampler,
+            num_workers=n_workers,
+            drop_last=True,
+        )
+    else:
+        loader = data.DataLoader(
+            dataset,
+            batch_size=data_dict["batch_size"],
+            shuffle=shuffle,
+            num_workers=n_workers,
+        )
     return loader
 
 def get_dataset(data_dict):
@@ -0,0 +1,112 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+class TensorLoader:
+    """
+    Batch loader for datasets that hold all their samples in the tensors dataset.data and dataset.targets.
+    Instead of indexing and collating sample by sample, the samples are permuted once per epoch and
+    every batch is a contiguous slice of the permuted tensors.
+    With world_size > 1 every rank draws the same permutation and returns its shard of each batch.
+    """
+
+    def __init__(self, dataset, batch_size, shuffle=True, drop_last=False, device=None, n_workers=0, prefetch=2,
+                 rank=0, world_size=1, seed=0):
+        """
+        :param device: if given, batches are moved to this device before they are returned
+        :param n_workers: number of threads preparing the next batches in the background, 0 loads in the main thread
+        :param prefetch: number of batches prepared ahead per worker
+        :param rank: index of this process among the world_size data-parallel processes
+        :param world_size: number of processes sharing each batch, incomplete last batches are dropped if > 1
+        :param seed: seed of the permutations shared by all ranks, only used if world_size > 1
+        """
+        self.dataset = dataset
+        self.data = dataset.data
+        self.targets = dataset.targets
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        # all ranks have to take the same number of steps
+        self.drop_last = drop_last or world_size > 1
+        self.device = device
+        self.n_workers = n_workers
+        self.prefetch = prefetch
+        self.rank = rank
+        self.world_size = world_size
+        self.generator = torch.Generator().manual_seed(seed) if world_size > 1 else None
+
+        # permutation of the current epoch and number of batches returned from it
+        self._perm = None
+        self._position = 0
+        self._resume = False
+
+    @staticmethod
+    def supports(dataset):
+        data, targets = getattr(dataset, "data", None), getattr(dataset, "targets", None)
+        return isinstance(data, torch.Tensor) and isinstance(targets, torch.Tensor) and len(data) == len(targets)
+
+    def __len__(self):
+        n = len(self.data)
+        if self.drop_last:
+            return n // self.batch_size
+        return (n + self.batch_size - 1) // self.batch_size
+
+    def state_dict(self):
+        state = {"perm": self._perm, "position": self._position}
+        if self.generator is not None:
+            state["generator"] = self.generator.get_state()
+        return state
+
+    def load_state_dict(self, state):
+        """
+        the next epoch continues the interrupted one, with the same order and after the returned batches
+        """
+        self._perm = state["perm"]
+        self._position = state["position"]
+        if self.generator is not None and "generator" in state:
+            self.generator.set_state(state["generator"])
+        self._resume = True
+
+    def _epoch_tensors(self):
+        if self._resume:
+            self._resume = False
+        else:
+            self._perm = torch.randperm(len(self.data), generator=self.generator) if self.shuffle else None
+            self._position = 0
+
+        if self._perm is None:
+            return self.data, self.targets
+        return self.data.index_select(0, self._perm), self.targets.index_select(0, self._perm)
+
+    def _get_batch(self, data, targets, i):
+        start = i * self.batch_size
+        x, y = data[start:start + self.batch_size], targets[start:start + self.batch_size]
+        if self.world_size > 1:
+            x, y = x.tensor_split(self.world_size)[self.rank], y.tensor_split(self.world_size)[self.rank]
+        if self.device is not None:
+            x, y = x.to(self.device, non_blocking=True), y.to(self.device, non_blocking=True)
+        return x, y
+
+    def __iter__(self):
+        data, targets = self._epoch_tensors()
+        n_batches = len(self)
+        start = self._position
+
+        if self.n_workers == 0:
+            for i in range(start, n_batches):
+                self._position = i + 1
+                yield self._get_batch(data, targets, i)
+            return
+
+        # keep a bounded number of batches in flight, in order
+        with ThreadPoolExecutor(self.n_workers) as pool:
+            in_flight = deque()
+            for i in range(start, n_batches):
+                in_flight.append(pool.submit(self._get_batch, data, targets, i))
+                if len(in_flight) > self.n_workers * self.prefetch:
+                    self._position += 1
+                    yield in_flight.popleft().result()
+            while in_flight:
+                self._position += 1
+                yield in_flight.popleft().result()
@@ -103,4 +103,13 @@ class averageMeter(object):
         self.val = val
         self.sum += val * n
         self.count += n
-        self.avg = self.sum / self.count
\ No newline at end of file
+        self.avg = self.sum / self.count
+
+    def state_dict(self):
+        return {"val": self.val, "avg": self.avg, "sum": self.sum, "count": self.count}
+
+    def load_state_dict(self, state):
+        self.val = state["val"]
+        self.avg = state["avg"]
+        self.sum = state["sum"]
+        self.count = state["count"]
\ No newline at end of file
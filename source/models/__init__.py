@@ -70,6 +70,12 @@ def get_ae(**model_cfg):
     x_dim = model_cfg['x_dim']
     z_dim = model_cfg['z_dim']
     arch = model_cfg["arch"]
+    # number and distribution of the probe vectors of the stochastic iso / conf regularizers
+    n_probes = model_cfg.get("n_probes", 1)
+    probe = model_cfg.get("probe", "gaussian")
+    # amortized regularizer of irae / confae / geomae: every reg_every-th step, on a reg_fraction of the batch
+    reg_every = model_cfg.get("reg_every", 1)
+    reg_fraction = model_cfg.get("reg_fraction", 1.0)
     if arch == "vae":
         encoder = get_net(in_dim=x_dim, out_dim=z_dim * 2, **model_cfg["encoder"])
         decoder = get_net(in_dim=z_dim, out_dim=x_dim, **model_cfg["decoder"])
@@ -79,13 +85,15 @@ def get_ae(**model_cfg):
         iso_reg = model_cfg.get("iso_reg", 1.0)
         encoder = get_net(in_dim=x_dim, out_dim=z_dim * 2, **model_cfg["encoder"])
         decoder = get_net(in_dim=z_dim, out_dim=x_dim, **model_cfg["decoder"])
-        model = IRVAE(encoder, IsotropicGaussian(decoder), iso_reg=iso_reg, metric=metric)
+        model = IRVAE(encoder, IsotropicGaussian(decoder), iso_reg=iso_reg, metric=metric,
+                      n_probes=n_probes, probe=probe)
     elif arch == "confvae":
         metric = model_cfg.get("metric", "identity")
         conf_reg = model_cfg.get("conf_reg", 1.0)
         encoder = get_net(in_dim=x_dim, out_dim=z_dim * 2, **model_cfg["encoder"])
         decoder = get_net(in_dim=z_dim, out_dim=x_dim, **model_cfg["decoder"])
-        model = ConfVAE(encoder, IsotropicGaussian(decoder), conf_reg=conf_reg, metric=metric)
+        model = ConfVAE(encoder, IsotropicGaussian(decoder), conf_reg=conf_reg, metric=metric,
+                        n_probes=n_probes, probe=probe)
     elif arch == "ae":
         encoder = get_net(in_dim=x_dim, out_dim=z_dim, **model_cfg["encoder"])
         decoder = get_net(in_dim=z_dim, out_dim=x_dim, **model_cfg["decoder"])
@@ -95,23 +103,39 @@ def get_ae(**model_cfg):
         iso_reg = model_cfg.get("iso_reg", 1.0)
         encoder = get_net(in_dim=x_dim, out_dim=z_dim, **model_cfg["encoder"])
         decoder = get_net(in_dim=z_dim, out_dim=x_dim, **model_cfg["decoder"])
-        model = IRAE(encoder, decoder, iso_reg=iso_reg, metric=metric)
+        model = IRAE(encoder, decoder, iso_reg=iso_reg, metric=metric, n_probes=n_probes, probe=probe,
+                     reg_every=reg_every, reg_fraction=reg_fraction)
     elif arch == "confae":
         metric = model_cfg.get("metric", "identity")
         conf_reg = model_cfg.get("conf_reg", 1.0)
         reg_type = model_cfg.get("reg_type", "conf")
+        # latent sizes up to exact_dim use the exact instead of the stochastic conformality loss
+        exact_dim = model_cfg.get("exact_dim", None)
         encoder = get_net(in_dim=x_dim, out_dim=z_dim, **model_cfg["encoder"])
         decoder = get_net(in_dim=z_dim, out_dim=x_dim, **model_cfg["decoder"])
-        model = ConfAE(encoder, decoder, conf_reg=conf_reg, metric=metric, reg_type=reg_type)
+        model = ConfAE(encoder, decoder, conf_reg=conf_reg, metric=metric, reg_type=reg_type,
+                       n_probes=n_probes, probe=probe, exact_dim=exact_dim,
+                       reg_every=reg_every, reg_fraction=reg_fraction)
     elif arch == "geomae":
         geom_reg = model_cfg.get("geom_reg", 1.0)
+        # "exact" logdet of the pushforward metric or its stochastic Lanczos quadrature estimate "slq"
+        logdet_estimator = model_cfg.get("logdet_estimator", "exact")
+        lanczos_steps = model_cfg.get("lanczos_steps", 10)
         encoder = get_net(in_dim=x_dim, out_dim=z_dim, **model_cfg["encoder"])
         decoder = get_net(in_dim=z_dim, out_dim=x_dim, **model_cfg["decoder"])
-        model = GeomAE(encoder, decoder, geom_reg=geom_reg)
+        model = GeomAE(encoder, decoder, geom_reg=geom_reg, logdet_estimator=logdet_estimator,
+                       n_probes=n_probes, probe=probe, lanczos_steps=lanczos_steps,
+                       reg_every=reg_every, reg_fraction=reg_fraction)
     elif arch == "topoae":
         encoder = get_net(in_dim=x_dim, out_dim=z_dim, **model_cfg["encoder"])
         decoder = get_net(in_dim=z_dim, out_dim=x_dim, **model_cfg["decoder"])
         model = TopologicallyRegularizedAutoencoder(encoder, decoder)
+    # eval_step: number of subsampled samples of the measures (all if null), without n x n matrices if knn_only
+    model.eval_samples = model_cfg.get("eval_samples", 201)
+    model.eval_knn_only = model_cfg.get("eval_knn_only", False)
+    # subset of the measures, e.g. [stress, density_kl_global_*]
+    eval_measures = model_cfg.get("eval_measures", None)
+    model.eval_measures = list(eval_measures) if eval_measures is not None else None
     return model
 
 def get_model(cfg, *args, version=None, **kwargs):
@@ -4,21 +4,43 @@ import torch.nn as nn
 
 import matplotlib.pyplot as plt
 from torchvision.utils import make_grid
-from utils.utils import label_to_color, figure_to_array, PD_metric_to_ellipse, random_metric_field_generator
+from utils.utils import label_to_color, figure_to_array, PD_metric_to_ellipse, PD_metrics_to_ellipse_params, random_metric_field_generator
 from evaluation.eval import Multi_Evaluation
+from utils import smallmat
+from utils.distributed import batch_var
 
 from geometry import (
     relaxed_distortion_measure,
     get_pushforwarded_Riemannian_metric,
-    get_flattening_scores,
+    get_all_flattening_scores,
+    get_metric_spectrum,
+    linearize,
+    stochastic_logdet,
 )
 
 
 class AE(nn.Module):
+    # name of the regularization weight, the model config key set by sweeps
+    reg_name = None
+    # loss_terms is built from tensor operations and functorch transforms only, so it can be vmapped
+    # over stacked parameters (see trainers.ensemble)
+    vmappable_loss = True
+
     def __init__(self, encoder, decoder):
         super(AE, self).__init__()
         self.encoder = encoder
         self.decoder = decoder
+        # amortized regularizer, see reg_batch
+        self.reg_every = 1
+        self.reg_fraction = 1.0
+        self._reg_steps = 0
+        self._reg_samples = 0
+        self._samples = 0
+        # number of samples of the measures of eval_step (all if None) and their kNN-only computation
+        self.eval_samples = 201
+        self.eval_knn_only = False
+        # names of the measures of eval_step, all if None
+        self.eval_measures = None
 
     def encode(self, x):
         return self.encoder(x)
@@ -31,49 +53,96 @@ class AE(nn.Module):
         recon = self.decode(z)
         return recon
 
+    def reg_batch(self, x):
+        """
+        Amortized regularizer: it is computed every reg_every-th step, on a random reg_fraction of the batch.
+        The regularizers are batch means (or variances), so a random sub-batch keeps their expectation, and
+        scaling them by reg_every keeps the expected gradient over the steps.
+        :return: the samples of x to compute the regularizer on (x itself for the whole batch, None to skip it)
+            and the scale of the regularizer
+        """
+        step = self._reg_steps
+        self._reg_steps += 1
+        self._samples += len(x)
+        if step % self.reg_every != 0:
+            return None, 0.
+        if self.reg_fraction < 1.0:
+            # at least two samples, GeomAE takes a variance over them
+            n_reg = max(int(round(self.reg_fraction * len(x))), 2)
+            x = x[torch.randperm(len(x), device=x.device)[:n_reg]]
+        self._reg_samples += len(x)
+        return x, float(self.reg_every)
+
+    def reg_cost(self):
+        """fraction of the training samples the regularizer was computed on so far"""
+        return self._reg_samples / max(self._samples, 1)
+
+    def reg_state_dict(self):
+        """counters of the amortized regularizer, to resume training in the same phase of reg_every"""
+        return {"reg_steps": self._reg_steps, "reg_samples": self._reg_samples, "samples": self._samples}
+
+    def load_reg_state_dict(self, state):
+        self._reg_steps = state["reg_steps"]
+        self._reg_samples = state["reg_samples"]
+        self._samples = state["samples"]
+
+    def loss_terms(self, x):
+        """
+        reconstruction loss and regularizer of a batch, the loss is mse + reg_weight * reg
+        """
+        recon = self(x)
+        mse = ((recon - x) ** 2).view(len(x), -1).mean(dim=1).mean()
+        return mse, torch.zeros_like(mse)
+
     def train_step(self, x, optimizer, **kwargs):
         optimizer.zero_grad()
-        recon = self(x)
-        loss = ((recon - x) ** 2).view(len(x), -1).mean(dim=1).mean()
+        loss, _ = self.loss_terms(x)
         loss.backward()
         optimizer.step()
-        return {"loss": loss.item(), "mse": loss.item(), "reg": 0.}
+        return {"loss": loss.detach(), "mse": loss.detach(), "reg": 0.}
 
     def validation_step(self, x, **kwargs):
         recon = self(x)
         loss = ((recon - x) ** 2).view(len(x), -1).mean(dim=1).mean()
-        return {"loss": loss.item()}
+        return {"loss": loss.detach()}
 
     def eval_step(self, dl, **kwargs):
         device = kwargs["device"]
         CN = []
         voR = []
         VP = []
+        G_all = []
 
         x_all = []
         z_all = []
         labels_all = []
         for x, labels in dl:
-            z = self.encode(x.to(device))
+            # only the metric needs gradients
+            with torch.inference_mode():
+                z = self.encode(x.to(device))
             G = get_pushforwarded_Riemannian_metric(self.encode, x.view(x.shape[0], -1).to(device))
-            CN.append(get_flattening_scores(G, mode="condition_number"))
-            voR.append(get_flattening_scores(G, mode="variance"))
-            VP.append(get_flattening_scores(G, mode="volume_preserving"))
+            scores = get_all_flattening_scores(G)
+            CN.append(scores["condition_number"])
+            voR.append(scores["variance"])
+            VP.append(scores["volume_preserving"])
+            G_all.append(G.detach())
             x_all.append(x)
             z_all.append(z)
             labels_all.append(labels)
 
-        recon_all = self.decode(torch.cat(z_all).to(device))
-        mse = ((recon_all - torch.cat(x_all).to(device)) ** 2).mean()
+        with torch.inference_mode():
+            recon_all = self.decode(torch.cat(z_all).to(device))
+            mse = ((recon_all - torch.cat(x_all).to(device)) ** 2).mean()
 
         voR = torch.cat(voR)
         CN = torch.cat(CN)
         VP = torch.cat(VP)
 
         G0 = random_metric_field_generator(len(VP), 2, 1, local_coordinates="exponential").to(device)
-        voR0 = get_flattening_scores(G0, mode="variance")
-        CN0 = get_flattening_scores(G0, mode="condition_number") - 1
-        VP0 = get_flattening_scores(G0, mode="volume_preserving")
+        scores0 = get_all_flattening_scores(G0)
+        voR0 = scores0["variance"]
+        CN0 = scores0["condition_number"] - 1
+        VP0 = scores0["volume_preserving"]
 
         voRrel = (voR / voR0).detach()
         CNrel = (CN / CN0).detach()
@@ -98,15 +167,21 @@ class AE(nn.Module):
 
         # TODO: ks here should be set in config
         ks = torch.arange(10, 210, 10)
-        s = 201
+        s = self.eval_samples if self.eval_samples is not None else len(x_all)
         indices = torch.randperm(len(x_all))[:s]
 
+        # the pushforward metric G lives on the tangent spaces of the data, its inverse measures latent lengths
+        latent_metrics = smallmat.inv(torch.cat(G_all)[indices]).cpu().numpy()
+
         evaluator = Multi_Evaluation(dataloader=dl, model=self)
         ev_result = evaluator.get_multi_evals(
             x_all[indices].reshape(len(x_all[indices]), -1),
             z_all[indices],
             labels_all[indices],
             ks=ks,
+            metrics=latent_metrics,
+            knn_only=self.eval_knn_only,
+            measures=self.eval_measures,
         )
 
         for key, value in ev_result.items():
@@ -122,7 +197,8 @@ class AE(nn.Module):
         num_each_axis = 10
 
         x = dl.dataset.data[torch.randperm(len(dl.dataset.data))[:num_figures]]
-        recon = self.decode(self.encode(x.to(device)))
+        with torch.inference_mode():
+            recon = self.decode(self.encode(x.to(device)))
         x_img = make_grid(
             x.detach().cpu(), nrow=num_each_axis, value_range=(0, 1), pad_value=1
         )
@@ -143,7 +219,8 @@ class AE(nn.Module):
             temp_data = dl.dataset.data[dl.dataset.targets == label][
                 :num_points_for_each_class
             ].to(device)
-            temp_z = self.encode(temp_data.to(device))
+            with torch.inference_mode():
+                temp_z = self.encode(temp_data.to(device))
             z_sampled = temp_z[torch.randperm(len(temp_z))[:num_G_plots_for_each_class]]
             x_sampled = temp_data[torch.randperm(len(temp_data))[:num_G_plots_for_each_class]]
             G = get_pushforwarded_Riemannian_metric(self.encode, x_sampled.view(x_sampled.shape[0], -1))
@@ -165,14 +242,17 @@ class AE(nn.Module):
         f = plt.figure()
         plt.title("Latent space embeddings with equidistant ellipses")
         z_scale = np.minimum(np.max(z_, axis=0), np.min(z_, axis=0))
-        eig_mean = torch.svd(G_).S.mean().item()
+        eig_mean = get_metric_spectrum(G_).mean().item()
         scale = 0.1 * z_scale * np.sqrt(eig_mean)
         alpha = 0.3
+        G_inv = smallmat.inv(G_)
+        widths, heights, angles = PD_metrics_to_ellipse_params(G_inv, scale)
         for idx in range(len(z_sampled_)):
             e = PD_metric_to_ellipse(
-                np.linalg.inv(G_[idx, :, :]),
+                G_inv[idx, :, :],
                 z_sampled_[idx, :],
                 scale,
+                ellipse_params=(widths[idx], heights[idx], angles[idx]),
                 fc=color_sampled_[idx, :] / 255.0,
                 alpha=alpha,
             )
@@ -197,95 +277,172 @@ class AE(nn.Module):
 
 
 class IRAE(AE):
-    def __init__(self, encoder, decoder, iso_reg=1.0, metric="identity"):
+    reg_name = "iso_reg"
+    # the regularizer differentiates with torch.autograd.grad
+    vmappable_loss = False
+
+    def __init__(self, encoder, decoder, iso_reg=1.0, metric="identity", n_probes=1, probe="gaussian",
+                 reg_every=1, reg_fraction=1.0):
         super(IRAE, self).__init__(encoder, decoder)
         self.iso_reg = iso_reg
         self.metric = metric
-
-    def train_step(self, x, optimizer, **kwargs):
-        optimizer.zero_grad()
-        z = self.encode(x)
+        self.n_probes = n_probes
+        self.probe = probe
+        self.reg_every = reg_every
+        self.reg_fraction = reg_fraction
+
+    def loss_terms(self, x):
+        x_reg, reg_scale = self.reg_batch(x)
+        if x_reg is x:
+            # the regularizer reuses this forward pass of the encoder
+            z, linearization = linearize(self.encode, x)
+        else:
+            z, linearization = self.encode(x), None
         recon = self.decode(z)
         mse = ((recon - x) ** 2).view(len(x), -1).mean(dim=1).mean()
+        if x_reg is None:
+            return mse, torch.zeros_like(mse)
 
         iso_loss = relaxed_distortion_measure(
-            self.encode, x.view(x.shape[0], -1), eta=None, metric=self.metric, reg="iso"
+            self.encode, x_reg, eta=None, metric=self.metric, reg="iso",
+            n_probes=self.n_probes, probe=self.probe, linearization=linearization
         )
+        return mse, reg_scale * iso_loss
 
+    def train_step(self, x, optimizer, **kwargs):
+        optimizer.zero_grad()
+        mse, iso_loss = self.loss_terms(x)
         loss = mse + self.iso_reg * iso_loss
 
         loss.backward()
         optimizer.step()
-        return {"loss": loss.item(), "mse": mse.item(), "reg": iso_loss.item()}
+        return {"loss": loss.detach(), "mse": mse.detach(), "reg": iso_loss.detach(), "reg_cost_": self.reg_cost()}
 
 
 class ConfAE(AE):
-    def __init__(self, encoder, decoder, conf_reg=1.0, metric="identity", reg_type="conf"):
+    reg_name = "conf_reg"
+    # the regularizer differentiates with torch.autograd.grad
+    vmappable_loss = False
+
+    def __init__(self, encoder, decoder, conf_reg=1.0, metric="identity", reg_type="conf",
+                 n_probes=1, probe="gaussian", exact_dim=None, reg_every=1, reg_fraction=1.0):
         super(ConfAE, self).__init__(encoder, decoder)
         self.conf_reg = conf_reg
         self.metric = metric
         self.reg_type = reg_type
-
-    def train_step(self, x, optimizer, **kwargs):
-        optimizer.zero_grad()
-        z = self.encode(x)
+        self.n_probes = n_probes
+        self.probe = probe
+        self.exact_dim = exact_dim
+        self.reg_every = reg_every
+        self.reg_fraction = reg_fraction
+
+    def loss_terms(self, x):
+        x_reg, reg_scale = self.reg_batch(x)
+        if self.reg_type == "conf-noapprox" or x_reg is not x:
+            z = self.encode(x)
+            linearization = None
+        else:
+            # the augmented regularizer points go through the encoder together with x
+            z, linearization = linearize(self.encode, x, eta=0.2)
         recon = self.decode(z)
         mse = ((recon - x) ** 2).view(len(x), -1).mean(dim=1).mean()
+        if x_reg is None:
+            return mse, torch.zeros_like(mse)
 
         conf_loss = relaxed_distortion_measure(
-            self.encode, x.view(x.shape[0], -1), eta=0.2, metric=self.metric, reg=self.reg_type
+            self.encode, x_reg.view(x_reg.shape[0], -1), eta=0.2, metric=self.metric, reg=self.reg_type,
+            n_probes=self.n_probes, probe=self.probe, linearization=linearization, exact_dim=self.exact_dim
         )
+        return mse, reg_scale * conf_loss
 
+    def train_step(self, x, optimizer, **kwargs):
+        optimizer.zero_grad()
+        mse, conf_loss = self.loss_terms(x)
         loss = mse + self.conf_reg * conf_loss
 
         loss.backward()
         optimizer.step()
-        return {"loss": loss.item(), "mse": mse.item(), "reg": conf_loss.item()}
+        return {"loss": loss.detach(), "mse": mse.detach(), "reg": conf_loss.detach(), "reg_cost_": self.reg_cost()}
 
 
 class GeomAE(AE):
-    def __init__(self, encoder, decoder, geom_reg=1.0):
+    reg_name = "geom_reg"
+
+    def __init__(self, encoder, decoder, geom_reg=1.0, logdet_estimator="exact", n_probes=1, probe="gaussian",
+                 lanczos_steps=10, reg_every=1, reg_fraction=1.0):
         super(GeomAE, self).__init__(encoder, decoder)
         self.geom_reg = geom_reg
+        self.logdet_estimator = logdet_estimator
+        self.n_probes = n_probes
+        self.probe = probe
+        self.lanczos_steps = lanczos_steps
+        self.reg_every = reg_every
+        self.reg_fraction = reg_fraction
+
+    @property
+    def vmappable_loss(self):
+        # the stochastic lanczos estimator differentiates with torch.autograd.grad
+        return self.logdet_estimator == "exact"
+
+    def loss_terms(self, x):
+        x_reg, reg_scale = self.reg_batch(x)
+        # the latent codes come out of the forward pass of the regularizer if it covers the whole batch
+        z = None
+        if x_reg is None:
+            logdetG = None
+        elif self.logdet_estimator == "slq":
+            # jacobian free, from matrix vector products with the graph of the forward pass
+            out, linearization = linearize(self.encode, x_reg)
+            logdetG = stochastic_logdet(
+                linearization, n_probes=self.n_probes, n_steps=self.lanczos_steps, probe=self.probe
+            )
+        elif self.logdet_estimator == "exact":
+            G, out = get_pushforwarded_Riemannian_metric(
+                self.encode, x_reg.view(x_reg.shape[0], -1), return_output=True
+            )
+            # G = get_pullbacked_Riemannian_metric(self.decode, z)
+            logdetG = smallmat.logdet(G)
+        else:
+            raise NotImplementedError
+        if x_reg is x:
+            z = out
+        else:
+            z = self.encode(x)
 
-    def train_step(self, x, optimizer, **kwargs):
-        optimizer.zero_grad()
         x = x.view(x.shape[0], -1)
-        z = self.encode(x)
         recon = self.decode(z)
-        mse = ((recon - x) ** 2).view(len(x), -1).mean(dim=1).mean()
-
-        bs = len(x)
-        x_perm = x[torch.randperm(bs)]
+        mse = ((recon.view(len(x), -1) - x) ** 2).mean(dim=1).mean()
+        if logdetG is None:
+            return mse, torch.zeros_like(mse)
 
-        eta = None
-        if eta is not None:
-            alpha = (torch.rand(bs) * (1 + 2 * eta) - eta).unsqueeze(1).to(x).squeeze()
-            x_augmented = alpha * x + (1 - alpha) * x_perm
-        else:
-            x_augmented = x
-            z_augmented = z
-
-        G = get_pushforwarded_Riemannian_metric(self.encode, x_augmented)
-        # G = get_pullbacked_Riemannian_metric(self.decode, z_augmented)
-        logdetG = torch.logdet(G)
         torch.nan_to_num(logdetG, nan=0.0, posinf=0.0, neginf=0.0)
-        geom_loss = torch.var(logdetG)
+        # variance over the whole batch, also if it is sharded over data-parallel processes
+        geom_loss = batch_var(logdetG)
         # geom_loss = torch.var(torch.log(
         #     torch.clip(torch.det(G), min=1.0e-4)
         #     ))
+        return mse, reg_scale * geom_loss
 
+    def train_step(self, x, optimizer, **kwargs):
+        optimizer.zero_grad()
+        mse, geom_loss = self.loss_terms(x)
         loss = mse + self.geom_reg * geom_loss
 
         loss.backward()
         optimizer.step()
-        return {"loss": loss.item(), "mse": mse.item(), "reg": geom_loss.item()}
+        return {"loss": loss.detach(), "mse": mse.detach(), "reg": geom_loss.detach(), "reg_cost_": self.reg_cost()}
 
 
 class VAE(AE):
+    vmappable_loss = False
+
     def __init__(self, encoder, decoder):
         super(VAE, self).__init__(encoder, decoder)
 
+    def loss_terms(self, x):
+        # the loss of a VAE is not a reconstruction error plus a weighted regularizer
+        raise NotImplementedError
+
     def encode(self, x):
         z = self.encoder(x)
         if len(z.size()) == 4:
@@ -329,7 +486,7 @@ class VAE(AE):
         optimizer.step()
 
         return {
-            "loss": loss.item(),
+            "loss": loss.detach(),
             # "nll_": nll.item(),
             # "kl_loss_": kl_loss.mean(),
             # "sigma_": self.decoder.sigma.item(),
@@ -337,16 +494,22 @@ class VAE(AE):
 
 
 class IRVAE(VAE):
+    reg_name = "iso_reg"
+
     def __init__(
         self,
         encoder,
         decoder,
         iso_reg=1.0,
         metric="identity",
+        n_probes=1,
+        probe="gaussian",
     ):
         super(IRVAE, self).__init__(encoder, decoder)
         self.iso_reg = iso_reg
         self.metric = metric
+        self.n_probes = n_probes
+        self.probe = probe
 
     def train_step(self, x, optimizer, **kwargs):
         optimizer.zero_grad()
@@ -356,27 +519,34 @@ class IRVAE(VAE):
         nll = -self.decoder.log_likelihood(x, z_sample)
         kl_loss = self.kl_loss(z)
         iso_loss = relaxed_distortion_measure(
-            self.encode, z_sample, eta=0.2, metric=self.metric, reg="iso"
+            self.encode, z_sample, eta=0.2, metric=self.metric, reg="iso",
+            n_probes=self.n_probes, probe=self.probe
         )
 
         loss = (nll + kl_loss).mean() + self.iso_reg * iso_loss
 
         loss.backward()
         optimizer.step()
-        return {"loss": loss.item(), "iso_loss_": iso_loss.item()}
+        return {"loss": loss.detach(), "iso_loss_": iso_loss.detach()}
 
 
 class ConfVAE(VAE):
+    reg_name = "conf_reg"
+
     def __init__(
         self,
         encoder,
         decoder,
         conf_reg=1.0,
         metric="identity",
+        n_probes=1,
+        probe="gaussian",
     ):
         super(ConfVAE, self).__init__(encoder, decoder)
         self.conf_reg = conf_reg
         self.metric = metric
+        self.n_probes = n_probes
+        self.probe = probe
 
     def train_step(self, x, optimizer, **kwargs):
         optimizer.zero_grad()
@@ -386,11 +556,12 @@ class ConfVAE(VAE):
         nll = -self.decoder.log_likelihood(x, z_sample)
         kl_loss = self.kl_loss(z)
         conf_loss = relaxed_distortion_measure(
-            self.encode, z_sample, eta=0.2, metric=self.metric, reg="conf"
+            self.encode, z_sample, eta=0.2, metric=self.metric, reg="conf",
+            n_probes=self.n_probes, probe=self.probe
         )
 
         loss = (nll + kl_loss).mean() + self.conf_reg * conf_loss
 
         loss.backward()
         optimizer.step()
-        return {"loss": loss.item(), "conf_loss_": conf_loss.item()}
+        return {"loss": loss.detach(), "conf_loss_": conf_loss.detach()}
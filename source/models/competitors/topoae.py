@@ -12,6 +12,9 @@ from models.ae import AE
 class TopologicallyRegularizedAutoencoder(AE):
     """Topologically regularized autoencoder, from the Topological Autoenocoder paper"""
 
+    # the persistence pairs are computed in numpy
+    vmappable_loss = False
+
     def __init__(
         self,
         encoder,
@@ -37,8 +40,7 @@ class TopologicallyRegularizedAutoencoder(AE):
         distances = torch.norm(x_flat[:, None] - x_flat, dim=2, p=p)
         return distances
 
-    def train_step(self, x, optimizer, **kwargs):
-        optimizer.zero_grad()
+    def loss_terms(self, x):
         z = self.encode(x)
         recon = self.decode(z)
         mse = ((recon - x) ** 2).view(len(x), -1).mean(dim=1).mean()
@@ -65,12 +67,16 @@ class TopologicallyRegularizedAutoencoder(AE):
         # normalize topo_error according to batch_size
         batch_size = dimensions[0]
         topo_loss = topo_error / float(batch_size)
+        return mse, topo_loss
 
+    def train_step(self, x, optimizer, **kwargs):
+        optimizer.zero_grad()
+        mse, topo_loss = self.loss_terms(x)
         loss = mse + self.lam * topo_loss
 
         loss.backward()
         optimizer.step()
-        return {"loss": loss.item(), "mse": mse.item(), "reg": topo_loss.item()}
+        return {"loss": loss.detach(), "mse": mse.detach(), "reg": topo_loss.detach()}
 
 
 class TopologicalSignatureDistance(nn.Module):
@@ -1,6 +1,7 @@
 import logging
 
 from torch.optim import SGD, Adam, ASGD, Adamax, Adadelta, Adagrad, RMSprop
+from torch.optim.lr_scheduler import CosineAnnealingLR, StepLR, ReduceLROnPlateau
 
 logger = logging.getLogger("ptsemseg")
 
@@ -14,6 +15,12 @@ key2opt = {
     "rmsprop": RMSprop,
 }
 
+key2sched = {
+    "cosine": CosineAnnealingLR,
+    "step": StepLR,
+    "plateau": ReduceLROnPlateau,
+}
+
 def get_optimizer(opt_dict, model_params):
     optimizer = _get_optimizer_instance(opt_dict)
 
@@ -33,4 +40,23 @@ def _get_optimizer_instance(opt_dict):
             raise NotImplementedError("Optimizer {} not implemented".format(opt_name))
 
         logger.info("Using {} optimizer".format(opt_name))
-        return key2opt[opt_name]
\ No newline at end of file
+        return key2opt[opt_name]
+
+
+def get_scheduler(sched_dict, optimizer, n_epoch=None):
+    """
+    learning rate scheduler, stepped once per epoch ('plateau': once per validation, with the validation loss).
+    T_max of 'cosine' defaults to n_epoch.
+    """
+    if sched_dict is None:
+        return None
+    sched_name = sched_dict["name"]
+    if sched_name not in key2sched:
+        raise NotImplementedError("Scheduler {} not implemented".format(sched_name))
+
+    params = {k: v for k, v in sched_dict.items() if k != "name"}
+    if sched_name == "cosine" and "T_max" not in params:
+        params["T_max"] = n_epoch
+
+    logger.info("Using {} scheduler".format(sched_name))
+    return key2sched[sched_name](optimizer, **params)
@@ -0,0 +1,178 @@
+"""
+Run a sweep of train.py jobs on the local machine, without a cluster scheduler.
+
+The grid over datasets, models, seeds and regularization weights is read from a sweep config
+(see configs/sweep.yml). Every run goes to <logdir>/<dataset>_z2/seed{s}/<run>, the layout
+expected by experiments/util.load_model. Runs with a model_iter_last.pkl, which the trainer writes
+when training stopped, are skipped. Unfinished runs with a model_latest.pkl continue from it with
+--resume, so an interrupted sweep is resumed by starting it again.
+
+The local cores are split into slots of threads_per_job cores. Each job is pinned to the cores of
+its slot and uses as many intra-op threads. Failed jobs are restarted up to max_retries times, from
+their latest checkpoint if they wrote one.
+
+    python source/sweep.py --sweep configs/sweep.yml
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+from collections import deque
+
+from omegaconf import OmegaConf
+
+TRAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "train.py")
+
+
+def get_jobs(sweep_cfg):
+    """
+    expand the grid of the sweep config, one job per run directory
+    """
+    jobs = {}
+    for dataset in sweep_cfg.datasets:
+        config_dir = os.path.join(sweep_cfg.get("config_dir", "configs"), dataset)
+        for model_name, model_cfg in sweep_cfg.models.items():
+            for seed in sweep_cfg.seeds:
+                for reg in model_cfg.get("regs", [None]):
+                    if reg is None:
+                        run = f"{model_name}_seed{seed}"
+                    else:
+                        run = f"{model_name}_reg{reg}_seed{seed}"
+                    logdir = os.path.join(sweep_cfg.logdir, f"{dataset}_z2", f"seed{seed}")
+
+                    args = [
+                        "--base_config", os.path.join(config_dir, "base_config.yml"),
+                        "--config", os.path.join(config_dir, model_cfg.config),
+                        "--logdir", logdir,
+                        "--run", run,
+                        "--seed", str(seed),
+                        "--device", str(sweep_cfg.get("device", "cpu")),
+                    ]
+                    if reg is not None:
+                        args += [f"--model.{model_cfg.reg_name}", str(reg)]
+                    for key, val in model_cfg.get("args", {}).items():
+                        args += [f"--{key}", str(val)]
+
+                    jobs[os.path.join(logdir, run)] = args
+    return jobs
+
+
+def is_done(rundir):
+    """the run finished training, the trainer writes model_iter_last.pkl after its last iteration"""
+    return os.path.exists(os.path.join(rundir, "model_iter_last.pkl"))
+
+
+def can_resume(rundir):
+    return os.path.exists(os.path.join(rundir, "model_latest.pkl"))
+
+
+def get_slots(threads_per_job, n_jobs=None):
+    """
+    split the cores this process may run on into disjoint sets of threads_per_job cores
+    """
+    cores = sorted(os.sched_getaffinity(0))
+    n_slots = max(len(cores) // threads_per_job, 1)
+    if n_jobs is not None:
+        n_slots = min(n_slots, n_jobs)
+    return [cores[i * threads_per_job:(i + 1) * threads_per_job] or cores for i in range(n_slots)]
+
+
+def launch(rundir, args, cores):
+    os.makedirs(rundir, exist_ok=True)
+    if can_resume(rundir):
+        # an interrupted or failed run continues from its latest checkpoint instead of starting over
+        args = args + ["--resume", rundir]
+    n_threads = len(cores)
+    env = dict(os.environ, OMP_NUM_THREADS=str(n_threads), MKL_NUM_THREADS=str(n_threads))
+    log = open(os.path.join(rundir, "sweep.log"), "a")
+    process = subprocess.Popen(
+        [sys.executable, TRAIN_SCRIPT] + args + ["--n_threads", str(n_threads)],
+        stdout=log,
+        stderr=subprocess.STDOUT,
+        env=env,
+        preexec_fn=lambda: os.sched_setaffinity(0, cores),
+    )
+    return process, log
+
+
+def run_sweep(jobs, slots, max_retries=1, poll_interval=1.0):
+    """
+    run the jobs {rundir: train.py arguments} with at most one job per slot
+    :return: run directories of the jobs that failed after all retries
+    """
+    queue = deque(
+        (rundir, args) for rundir, args in jobs.items()
+        if not is_done(rundir)
+    )
+    print(f"{len(queue)} of {len(jobs)} runs to do, {len(slots)} slots of {len(slots[0])} cores")
+
+    retries = {rundir: 0 for rundir, _ in queue}
+    free_slots = list(range(len(slots)))
+    running = {}
+    failed = []
+
+    while queue or running:
+        while queue and free_slots:
+            rundir, args = queue.popleft()
+            slot = free_slots.pop()
+            process, log = launch(rundir, args, slots[slot])
+            running[rundir] = (process, log, slot, args)
+            print(f"{'resumed' if can_resume(rundir) else 'started'} {rundir} on cores {slots[slot]}")
+
+        time.sleep(poll_interval)
+
+        for rundir, (process, log, slot, args) in list(running.items()):
+            returncode = process.poll()
+            if returncode is None:
+                continue
+            log.close()
+            free_slots.append(slot)
+            del running[rundir]
+
+            if returncode == 0:
+                print(f"finished {rundir}")
+            elif retries[rundir] < max_retries:
+                retries[rundir] += 1
+                print(f"{rundir} failed with exit code {returncode}, restart {retries[rundir]}/{max_retries}")
+                queue.append((rundir, args))
+            else:
+                print(f"{rundir} failed with exit code {returncode}, see {os.path.join(rundir, 'sweep.log')}")
+                failed.append(rundir)
+
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sweep", type=str, default="configs/sweep.yml")
+    parser.add_argument("--n_jobs", type=int, default=None)
+    parser.add_argument("--threads_per_job", type=int, default=None)
+    parser.add_argument("--dry_run", action="store_true")
+    args = parser.parse_args()
+
+    sweep_cfg = OmegaConf.load(args.sweep)
+    threads_per_job = args.threads_per_job or sweep_cfg.get("threads_per_job", 2)
+    n_jobs = args.n_jobs or sweep_cfg.get("n_jobs", None)
+
+    jobs = get_jobs(sweep_cfg)
+    slots = get_slots(threads_per_job, n_jobs)
+
+    if args.dry_run:
+        for rundir, job_args in jobs.items():
+            if is_done(rundir):
+                status = "done"
+            elif can_resume(rundir):
+                status = "resume"
+            else:
+                status = "todo"
+            print(f"{status}\t{rundir}\t{' '.join(job_args)}")
+        sys.exit(0)
+
+    failed = run_sweep(jobs, slots, max_retries=sweep_cfg.get("max_retries", 1))
+    if failed:
+        print(f"{len(failed)} runs failed:")
+        for rundir in failed:
+            print(rundir)
+        sys.exit(1)
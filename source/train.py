@@ -3,6 +3,8 @@ import numpy as np
 import os
 import random
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 from tensorboardX import SummaryWriter
 
 import argparse
@@ -15,9 +17,6 @@ from trainers import get_trainer, get_logger
 from loader import get_dataloader
 from optimizers import get_optimizer
 
-# not using wandb currently ...
-import wandb
-
 def parse_arg_type(val):
     if val.isnumeric():
         return int(val)
@@ -59,28 +58,53 @@ def parse_nested_args(d_cmd_cfg):
                 d = d[each_key]
     return d_new_cfg
 
-def run(cfg, writer):
-    # Setup seeds
-    print(cfg)
-    seed = cfg.get('seed', 1)
-    print(f"running with random seed : {seed}")
+def set_seed(seed):
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
     np.random.seed(seed)
     random.seed(seed)
-    torch.set_num_threads(8)
+
+def init_wandb(cfg, logdir):
+    if cfg["logger"].get("backend", "wandb") == "wandb":
+        import wandb
+        wandb.init(
+            entity='pnazari',
+            project=cfg['wandb_project_name'],
+            config=OmegaConf.to_container(cfg),
+            name=logdir
+        )
+
+def run(cfg, writer, resume=None, logdir=None, rank=0, world_size=1):
+    """
+    :param logdir: directory of the checkpoints, by default the one of writer
+    :param rank, world_size: this process in data-parallel training, see run_distributed. Only rank 0 has a writer.
+    """
+    # Setup seeds
+    if rank == 0:
+        print(cfg)
+    seed = cfg.get('seed', 1)
+    print(f"running with random seed : {seed}")
+    set_seed(seed)
+    # the ranks share the cores of the machine
+    torch.set_num_threads(max(cfg.get("n_threads", 8) // world_size, 1))
     
     # Setup device
     device = cfg.device
 
-    # Setup dataloader
+    # Setup dataloader, only the training batches are sharded
     d_dataloaders = {}
     for key, dataloader_cfg in cfg.data.items():
-        d_dataloaders[key] = get_dataloader(dataloader_cfg)
+        if key == "training":
+            d_dataloaders[key] = get_dataloader(dataloader_cfg, device=device, rank=rank, world_size=world_size, seed=seed)
+        else:
+            d_dataloaders[key] = get_dataloader(dataloader_cfg, device=device)
 
     # Setup model and logger
     model = get_model(cfg).to(device)
-    logger = get_logger(cfg, writer)
+    if world_size > 1:
+        # same initialization on all ranks, but independent noise (e.g. probes of the regularizers) in training
+        set_seed(seed + rank)
+    logger = get_logger(cfg, writer, enabled=rank == 0)
 
     # Setup optimizer
     optimizer = get_optimizer(
@@ -94,7 +118,81 @@ def run(cfg, writer):
         model,
         d_dataloaders,
         logger=logger,
-        logdir=writer.file_writer.get_logdir(),
+        logdir=logdir if logdir is not None else writer.file_writer.get_logdir(),
+        resume=resume,
+    )
+
+def run_distributed(rank, world_size, cfg, logdir, port, resume=None):
+    """
+    One of world_size local processes of data-parallel training over a gloo process group.
+    Rank 0 owns the tensorboard writer and the wandb run.
+    """
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    writer = None
+    if rank == 0:
+        writer = SummaryWriter(logdir=logdir)
+        init_wandb(cfg, logdir)
+    try:
+        run(cfg, writer, resume=resume, logdir=logdir, rank=rank, world_size=world_size)
+    finally:
+        dist.destroy_process_group()
+
+def run_ensemble(cfg, writer, root, model_name):
+    """
+    Train one member per combination of cfg.ensemble.seeds and cfg.ensemble.regs at once.
+    Every member gets the directory and config file of a single run,
+    <root>/seed{s}/<model_name>_reg{r}_seed{s} (<model_name>_seed{s} without regs).
+    The regs are best given as strings, they are used verbatim in the directory names.
+    """
+    print(cfg)
+    device = cfg.device
+    torch.set_num_threads(cfg.get("n_threads", 8))
+
+    d_dataloaders = {}
+    for key, dataloader_cfg in cfg.data.items():
+        d_dataloaders[key] = get_dataloader(dataloader_cfg, device=device)
+
+    models, regs, names, logdirs = [], [], [], []
+    for seed in cfg.ensemble.seeds:
+        for reg in cfg.ensemble.get("regs", [None]):
+            member_cfg = OmegaConf.merge(cfg, {"seed": seed})
+            member_cfg.pop("ensemble")
+            member_cfg.trainer = "base"
+            # same initialization as a single run with this seed
+            torch.manual_seed(seed)
+            torch.cuda.manual_seed(seed)
+            np.random.seed(seed)
+            random.seed(seed)
+            model = get_model(member_cfg).to(device)
+
+            if reg is None:
+                name = f"{model_name}_seed{seed}"
+                regs.append(0.)
+            else:
+                name = f"{model_name}_reg{reg}_seed{seed}"
+                setattr(model, model.reg_name, float(reg))
+                member_cfg.model[model.reg_name] = float(reg)
+                regs.append(float(reg))
+
+            logdir = os.path.join(root, f"seed{seed}", name)
+            os.makedirs(logdir, exist_ok=True)
+            save_yaml(os.path.join(logdir, f"{model_name}.yml"), OmegaConf.to_yaml(member_cfg))
+
+            models.append(model)
+            names.append(name)
+            logdirs.append(logdir)
+
+    logger = get_logger(cfg, writer)
+    trainer = get_trainer(None, cfg)
+    models, train_result = trainer.train(
+        models,
+        d_dataloaders,
+        regs=regs,
+        names=names,
+        logdirs=logdirs,
+        logger=logger,
     )
 
 if __name__ == "__main__":
@@ -103,6 +201,12 @@ if __name__ == "__main__":
     parser.add_argument("--config", type=str)
     parser.add_argument("--device", default='any')
     parser.add_argument("--run", default=None)
+    # config with an ensemble block (seeds, regs), trains all members in one run
+    parser.add_argument("--ensemble", default=None)
+    # checkpoint to continue from, or a run directory to continue from its model_latest.pkl
+    parser.add_argument("--resume", default=None)
+    # number of local processes of data-parallel training, splitting every batch (overrides cfg.n_procs)
+    parser.add_argument("--n_procs", type=int, default=None)
     args, unknown = parser.parse_known_args()
     d_cmd_cfg = parse_unknown_args(unknown)
     d_cmd_cfg = parse_nested_args(d_cmd_cfg)
@@ -111,6 +215,8 @@ if __name__ == "__main__":
     base_cfg = OmegaConf.load(args.base_config)
     cfg = OmegaConf.load(args.config)
     cfg = OmegaConf.merge(base_cfg, cfg)
+    if args.ensemble is not None:
+        cfg = OmegaConf.merge(cfg, OmegaConf.load(args.ensemble))
     cfg = OmegaConf.merge(cfg, d_cmd_cfg)
     print(OmegaConf.to_yaml(cfg))
 
@@ -132,21 +238,34 @@ if __name__ == "__main__":
         logdir = cfg["logdir"]
     else:
         logdir = args.logdir
+    root = logdir
     logdir = os.path.join(logdir, run_id)
+    n_procs = args.n_procs if args.n_procs is not None else cfg.get("n_procs", 1)
+    if n_procs > 1 and cfg.get("ensemble") is not None:
+        raise NotImplementedError("ensembles can not be trained data-parallel")
+    if args.resume is not None and cfg.get("ensemble") is not None:
+        raise NotImplementedError("ensembles can not be resumed")
 
-    writer = SummaryWriter(logdir=logdir)
     print("Result directory: {}".format(logdir))
+    os.makedirs(logdir, exist_ok=True)
 
     # copy config file
     copied_yml = os.path.join(logdir, os.path.basename(args.config))
     save_yaml(copied_yml, OmegaConf.to_yaml(cfg))
     print(f"config saved as {copied_yml}")
 
-    wandb.init(
-        entity='pnazari',
-        project=cfg['wandb_project_name'],
-        config=OmegaConf.to_container(cfg),
-        name=logdir
-    )
-    
-    run(cfg, writer)
\ No newline at end of file
+    resume = args.resume
+    if resume is not None and os.path.isdir(resume):
+        resume = os.path.join(resume, "model_latest.pkl")
+
+    if n_procs > 1:
+        port = cfg.get("master_port", 29500)
+        mp.spawn(run_distributed, args=(n_procs, cfg, logdir, port, resume), nprocs=n_procs, join=True)
+    else:
+        writer = SummaryWriter(logdir=logdir)
+        init_wandb(cfg, logdir)
+        if cfg.get("ensemble") is not None:
+            cfg.trainer = "ensemble"
+            run_ensemble(cfg, writer, root, config_basename)
+        else:
+            run(cfg, writer, resume=resume)
\ No newline at end of file
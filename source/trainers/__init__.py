@@ -1,4 +1,7 @@
+import os
+
 from trainers.trainer import BaseTrainer
+from trainers.ensemble import EnsembleTrainer
 from trainers.logger import BaseLogger
 
 def get_trainer(optimizer, cfg):
@@ -6,11 +9,20 @@ def get_trainer(optimizer, cfg):
     device = cfg["device"]
     if trainer_type == "base":
         trainer = BaseTrainer(optimizer, cfg["training"], device=device)
+    elif trainer_type == "ensemble":
+        # builds its optimizer over the stacked parameters of the members itself
+        trainer = EnsembleTrainer(cfg["training"]["optimizer"], cfg["training"], device=device)
     return trainer
 
-def get_logger(cfg, writer):
+def get_logger(cfg, writer, enabled=True):
     logger_type = cfg["logger"].get("type", "base")
     endwith = cfg["logger"].get("endwith", [])
+    # 'local' logs to tensorboard and metrics.jsonl only, without wandb
+    backend = cfg["logger"].get("backend", "wandb")
+    if backend == "local" and enabled:
+        jsonl_path = os.path.join(writer.file_writer.get_logdir(), "metrics.jsonl")
+    else:
+        jsonl_path = None
     if logger_type in ["base"]:
-        logger = BaseLogger(writer, endwith=endwith)
+        logger = BaseLogger(writer, endwith=endwith, backend=backend, jsonl_path=jsonl_path, enabled=enabled)
     return logger
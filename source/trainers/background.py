@@ -0,0 +1,107 @@
+import copy
+import queue
+import time
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+
+from trainers.trainer import snapshot
+
+
+def _worker(model, d_dataloaders, device, n_threads, jobs, results):
+    torch.set_num_threads(n_threads)
+    model = model.to(device)
+    model.eval()
+    # the jacobians of the evaluation are taken w.r.t. the inputs only
+    model.requires_grad_(False)
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        kind, i_iter, state = job
+        start_ts = time.time()
+        try:
+            model.load_state_dict(state)
+            if kind == "eval":
+                d_result = model.eval_step(d_dataloaders["validation"], device=device)
+            else:
+                d_result = model.visualization_step(d_dataloaders["training"], device=device)
+            results.put((kind, i_iter, d_result, time.time() - start_ts, None))
+        except Exception:
+            results.put((kind, i_iter, None, time.time() - start_ts, traceback.format_exc()))
+
+
+class BackgroundEvaluator:
+    """
+    Runs eval_step and visualization_step of a model in a separate process, on a copy of the weights
+    at the time of submission, so that training continues meanwhile.
+    At most one job per kind ("eval", "vis") is in flight, submissions while it runs are skipped.
+    """
+    def __init__(self, model, d_dataloaders, device, n_threads=1):
+        ctx = mp.get_context("spawn")
+        self._jobs = ctx.Queue()
+        self._results = ctx.Queue()
+        self._in_flight = {"eval": False, "vis": False}
+        self._process = ctx.Process(
+            target=_worker,
+            args=(copy.deepcopy(model).to("cpu"), d_dataloaders, device, n_threads, self._jobs, self._results),
+            daemon=True,
+        )
+        self._process.start()
+
+    def submit(self, kind, i_iter, model):
+        """
+        :return: False if the job was skipped because the previous one of this kind is still running
+        """
+        if self._in_flight[kind]:
+            return False
+        self._in_flight[kind] = True
+        self._jobs.put((kind, i_iter, snapshot(model.state_dict())))
+        return True
+
+    def _check_alive(self):
+        if not self._process.is_alive():
+            raise RuntimeError(
+                f"background evaluation worker died with exit code {self._process.exitcode}, "
+                f"jobs in flight: {[kind for kind, busy in self._in_flight.items() if busy]}"
+            )
+
+    def _receive(self, block):
+        """the next result, raises queue.Empty if not block and there is none yet"""
+        while True:
+            try:
+                kind, i_iter, d_result, seconds, error = self._results.get(timeout=1.0) if block \
+                    else self._results.get(block=False)
+                break
+            except queue.Empty:
+                # a worker that was killed (e.g. out of memory) never answers
+                self._check_alive()
+                if not block:
+                    raise
+        self._in_flight[kind] = False
+        if error is not None:
+            raise RuntimeError(f"background {kind} of iter {i_iter} failed:\n{error}")
+        return kind, i_iter, d_result, seconds
+
+    def poll(self):
+        """finished jobs as (kind, i_iter, result, seconds the worker spent on it), without waiting"""
+        finished = []
+        while True:
+            try:
+                finished.append(self._receive(block=False))
+            except queue.Empty:
+                return finished
+
+    def close(self):
+        """wait for the jobs in flight and stop the worker, returns their results as poll"""
+        finished = []
+        while any(self._in_flight.values()):
+            finished.append(self._receive(block=True))
+        self._jobs.put(None)
+        self._process.join(timeout=60)
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join()
+        return finished
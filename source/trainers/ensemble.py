@@ -0,0 +1,142 @@
+import copy
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.func import stack_module_state, functional_call, vmap
+
+from metrics import averageMeter
+from optimizers import get_optimizer
+from trainers.trainer import BaseTrainer
+
+
+class _MemberLoss(nn.Module):
+    """Exposes the loss terms (training) and the mse (validation) of a model as forward, for functional_call"""
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x, validation=False):
+        if validation:
+            recon = self.model(x)
+            return ((recon - x) ** 2).view(len(x), -1).mean(dim=1).mean()
+        return self.model.loss_terms(x)
+
+
+class EnsembleTrainer(BaseTrainer):
+    """
+    Trains an ensemble of models of the same architecture at once.
+    The parameters of the members are stacked and their loss terms are vmapped over the ensemble,
+    so one data pipeline and one optimizer step serve all members. Every member has its own
+    regularization weight and is checkpointed to its own directory.
+    """
+    def __init__(self, optimizer_cfg, training_cfg, device):
+        super().__init__(None, training_cfg, device)
+        self.optimizer_cfg = optimizer_cfg
+
+    @staticmethod
+    def _load_member(model, params, buffers, i):
+        # strip the "model." prefix of _MemberLoss
+        state = {key[6:]: val[i].detach() for key, val in {**params, **buffers}.items()}
+        model.load_state_dict(state)
+
+    def train(self, models, d_dataloaders, regs, names, logdirs, logger=None):
+        """
+        :param models: initialized members, each built with its own seed
+        :param regs: regularization weight of each member
+        :param names: run name of each member, used as logging prefix
+        :param logdirs: checkpoint directory of each member
+        """
+        cfg = self.training_cfg
+        for model in models:
+            if not model.vmappable_loss:
+                raise NotImplementedError(f"the loss of {type(model).__name__} can not be vmapped")
+
+        members = [_MemberLoss(model) for model in models]
+        params, buffers = stack_module_state(members)
+        base = copy.deepcopy(members[0]).to("meta")
+        regs = torch.tensor(regs, dtype=torch.float32, device=self.device)
+        self.optimizer = get_optimizer(self.optimizer_cfg, params.values())
+
+        def member_loss_terms(params, buffers, x):
+            return functional_call(base, (params, buffers), (x,))
+
+        def member_mse(params, buffers, x):
+            return functional_call(base, (params, buffers), (x,), {"validation": True})
+
+        # the batch is shared by all members
+        ensemble_loss_terms = vmap(member_loss_terms, in_dims=(0, 0, None), randomness="different")
+        ensemble_mse = vmap(member_mse, in_dims=(0, 0, None), randomness="different")
+
+        time_meter = averageMeter()
+        train_loader, val_loader = (d_dataloaders["training"], d_dataloaders["validation"])
+        i_iter = 0
+        best_val_loss = torch.full((len(models),), np.inf)
+
+        for i_epoch in range(1, cfg['n_epoch'] + 1):
+            for x, _ in train_loader:
+                i_iter += 1
+
+                base.train()
+                logger.reset_train()
+                start_ts = time.time()
+                self.optimizer.zero_grad()
+                mse, reg = ensemble_loss_terms(params, buffers, x.to(self.device))
+                loss = mse + regs * reg
+                # the members do not interact, the gradient of the sum is the gradient of each member
+                loss.sum().backward()
+                self.optimizer.step()
+                time_meter.update(time.time() - start_ts)
+
+                loss, mse, reg = loss.detach(), mse.detach(), reg.detach()
+                d_train = {"loss": loss.mean(), "mse": mse.mean(), "reg": reg.mean()}
+                for name, member_loss in zip(names, loss):
+                    d_train[f"{name}/train_loss_"] = member_loss
+                logger.process_iter_train(d_train)
+
+                if i_iter % cfg.print_interval == 0:
+                    d_train = logger.summary_train(i_iter)
+                    print(
+                        f"Epoch [{i_epoch:d}] \nIter [{i_iter:d}]\tAvg Loss: {d_train['loss/train_loss_']:.6f}\tElapsed time: {time_meter.sum:.4f}"
+                    )
+                    time_meter.reset()
+
+                base.eval()
+                if i_iter % cfg.val_interval == 0:
+                    with torch.no_grad():
+                        val_loss = torch.stack(
+                            [ensemble_mse(params, buffers, x.to(self.device)) for x, _ in val_loader]
+                        ).mean(dim=0).cpu()
+                    d_val = {"loss/val_loss_": val_loss.mean().item()}
+                    for name, member_loss in zip(names, val_loss.tolist()):
+                        d_val[f"{name}/val_loss_"] = member_loss
+                    d_val = logger.summary_val(i_iter, d_val)
+                    print(d_val['print_str'])
+
+                    for i in torch.nonzero(val_loss < best_val_loss).flatten().tolist():
+                        print(f'Iter [{i_iter:d}] best model of {names[i]} saved {val_loss[i]:.6f} <= {best_val_loss[i]:.6f}')
+                        best_val_loss[i] = val_loss[i]
+                        self._load_member(models[i], params, buffers, i)
+                        self.save_model(models[i], logdirs[i], best=True)
+
+                if (cfg.eval_interval is not None) and (i_iter % cfg.eval_interval == 0):
+                    for i, (model, name) in enumerate(zip(models, names)):
+                        self._load_member(model, params, buffers, i)
+                        model.eval()
+                        d_eval = model.eval_step(val_loader, device=self.device)
+                        logger.add_val(i_iter, {f"{name}/{key}": val for key, val in d_eval.items()})
+
+                if (cfg.visualize_interval is not None) and (i_iter % cfg.visualize_interval) == 0:
+                    for i, (model, name) in enumerate(zip(models, names)):
+                        self._load_member(model, params, buffers, i)
+                        model.eval()
+                        d_val = model.visualization_step(train_loader, device=self.device)
+                        logger.add_val(i_iter, {f"{name}/{key}": val for key, val in d_val.items()})
+
+        for i, (model, logdir) in enumerate(zip(models, logdirs)):
+            self._load_member(model, params, buffers, i)
+            self.save_model(model, logdir, i_iter="last")
+        self.wait_for_checkpoints()
+        logger.flush()
+        return models, best_val_loss.tolist()
@@ -1,5 +1,12 @@
+import json
+import queue
+import threading
+import traceback
+
+import torch
+
 from metrics import averageMeter
-import wandb
+
 
 class BaseLogger:
     """BaseLogger that can handle most of the logging
@@ -8,11 +15,33 @@ class BaseLogger:
     'loss' has to be exist in all training settings
     endswith('_') : scalar
     endswith('@') : image
+    endswith('#') : figure
+
+    Logged values are buffered and written by a worker thread, one batched write per summary.
+    Scalars may be tensors on the training device, they are only copied to the host when written.
+    backend 'wandb' writes to TensorBoard and wandb, 'local' to TensorBoard and the JSONL file
+    jsonl_path (one line of scalars per summary) and does not import wandb.
+    A logger that is not enabled (ranks other than 0 of data-parallel training) keeps its meters but writes nothing.
     """
-    def __init__(self, tb_writer, endwith=[]):
+    def __init__(self, tb_writer, endwith=[], backend="wandb", jsonl_path=None, enabled=True):
         """tb_writer: tensorboard SummaryWriter"""
         self.writer = tb_writer
         self.endwith = endwith
+        self.backend = backend
+        self.enabled = enabled
+        if not enabled:
+            self.wandb = None
+        elif backend == "wandb":
+            import wandb
+            self.wandb = wandb
+            # iterations as explicit x-axis, results of background evaluations arrive after later iterations
+            wandb.define_metric("*", step_metric="iter")
+        elif backend == "local":
+            self.wandb = None
+        else:
+            raise NotImplementedError(f"logger backend {backend} not implemented")
+        self.jsonl_file = open(jsonl_path, "a") if enabled and jsonl_path is not None else None
+
         self.train_loss_meter = averageMeter()
         self.train_mse_meter = averageMeter()
         self.train_reg_meter = averageMeter()
@@ -22,26 +51,75 @@ class BaseLogger:
         self.d_train = {}
         self.d_val = {}
 
+        self._queue = queue.Queue()
+        if enabled:
+            self._worker = threading.Thread(target=self._work, daemon=True)
+            self._worker.start()
+
+    def _work(self):
+        while True:
+            i, d_result = self._queue.get()
+            try:
+                self._write(i, d_result)
+            except Exception:
+                # a failed write loses this summary only, the worker keeps draining the queue so flush returns
+                print(f"logging of iter {i} failed:\n{traceback.format_exc()}")
+            finally:
+                self._queue.task_done()
+
+    def _write(self, i, d_result):
+        scalars = {}
+        wandb_dict = {}
+        for key, val in d_result.items():
+            if key.endswith('_'):
+                scalars[key] = float(val)
+            elif key.endswith('@') and ('@' in self.endwith):
+                if val is not None:
+                    self.writer.add_image(key, val, i)
+                    if self.wandb is not None:
+                        wandb_dict[key] = [self.wandb.Image(val)]
+            elif key.endswith('#') and ('#' in self.endwith):
+                if val is not None:
+                    self.writer.add_figure(key, val, i)
+
+        for key, val in scalars.items():
+            self.writer.add_scalar(key, val, i)
+        if self.wandb is not None:
+            self.wandb.log({"iter": i, **scalars, **wandb_dict})
+        if self.jsonl_file is not None and scalars:
+            self.jsonl_file.write(json.dumps({"step": i, **scalars}) + "\n")
+
+    def _log(self, i, d_result):
+        """queue the loggable entries of d_result, detached so that the worker does not keep graphs alive"""
+        if not self.enabled:
+            return
+        d_log = {}
+        for key, val in d_result.items():
+            if key.endswith(('_', '@', '#')):
+                d_log[key] = val.detach() if isinstance(val, torch.Tensor) else val
+        self._queue.put((i, d_log))
+
+    def flush(self):
+        """block until everything logged so far is written"""
+        if not self.enabled:
+            return
+        self._queue.join()
+        self.writer.flush()
+        if self.jsonl_file is not None:
+            self.jsonl_file.flush()
+
     def process_iter_train(self, d_result):
         self.train_loss_meter.update(d_result['loss'])
-        self.train_mse_meter.update(d_result['mse'])
-        self.train_reg_meter.update(d_result['reg'])
+        self.train_mse_meter.update(d_result.get('mse', 0.))
+        self.train_reg_meter.update(d_result.get('reg', 0.))
         self.d_train = d_result
 
     def summary_train(self, i):
         self.d_train['loss/train_loss_'] = self.train_loss_meter.avg
         self.d_train['loss/train_mse_'] = self.train_mse_meter.avg
         self.d_train['loss/train_reg_'] = self.train_reg_meter.avg
-        for key, val in self.d_train.items():
-            if key.endswith('_'):
-                self.writer.add_scalar(key, val, i)
-                wandb.log({key: val}, step=i)
-            if key.endswith('@') and ('@' in self.endwith):
-                if val is not None:
-                    self.writer.add_image(key, val, i)
-                    wandb_dict = {key: [wandb.Image(val)]}
-                    wandb.log(wandb_dict, step=i)
-                    
+        self._log(i, self.d_train)
+
         result = self.d_train
         self.d_train = {}
         return result
@@ -55,20 +133,14 @@ class BaseLogger:
     def summary_val(self, i, d_val=None):
         if d_val is None:
             d_val = self.d_val
-            d_val['loss/val_loss_'] = self.val_loss_meter.avg 
+            d_val['loss/val_loss_'] = self.val_loss_meter.avg
             #d_val['loss/val_mse_'] = self.val_mse_meter.avg
             #d_val['loss/val_reg_'] = self.val_reg_meter.avg
+        self._log(i, d_val)
         l_print_str = [f'Iter [{i:d}]']
         for key, val in d_val.items():
             if key.endswith('_'):
-                self.writer.add_scalar(key, val, i)
                 l_print_str.append(f'\t{key[:-1]}: {val:.4f}')
-                wandb.log({key: val}, step=i)
-            if key.endswith('@') and ('@' in self.endwith):
-                if val is not None:
-                    self.writer.add_image(key, val, i)
-                    wandb_dict = {key: [wandb.Image(val)]}
-                    wandb.log(wandb_dict, step=i)
 
         print_str = ' '.join(l_print_str)
 
@@ -76,7 +148,21 @@ class BaseLogger:
         result['print_str'] = print_str
         self.d_val = {}
         return result
-     
+
+    def state_dict(self):
+        return {
+            "train_loss_meter": self.train_loss_meter.state_dict(),
+            "train_mse_meter": self.train_mse_meter.state_dict(),
+            "train_reg_meter": self.train_reg_meter.state_dict(),
+            "val_loss_meter": self.val_loss_meter.state_dict(),
+        }
+
+    def load_state_dict(self, state):
+        self.train_loss_meter.load_state_dict(state["train_loss_meter"])
+        self.train_mse_meter.load_state_dict(state["train_mse_meter"])
+        self.train_reg_meter.load_state_dict(state["train_reg_meter"])
+        self.val_loss_meter.load_state_dict(state["val_loss_meter"])
+
     def reset_val(self):
         self.val_loss_meter.reset()
         #self.val_mse_meter.reset()
@@ -86,17 +172,6 @@ class BaseLogger:
         self.train_loss_meter.reset()
         self.train_mse_meter.reset()
         self.train_reg_meter.reset()
-        
+
     def add_val(self, i, d_result):
-        for key, val in d_result.items():
-            if key.endswith('_'):
-                self.writer.add_scalar(key, val, i)
-                wandb.log({key: val}, step=i)
-            if key.endswith('@') and ('@' in self.endwith):
-                if val is not None:
-                    self.writer.add_image(key, val, i)
-                    wandb_dict = {key: [wandb.Image(val)]}
-                    wandb.log(wandb_dict, step=i)
-            elif key.endswith('#') and ('#' in self.endwith):
-                if val is not None:
-                    self.writer.add_figure(key, val, i)
\ No newline at end of file
+        self._log(i, d_result)
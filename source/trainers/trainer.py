@@ -1,29 +1,261 @@
 import os
+import copy
 import time
 import math
+import random
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
 from metrics import averageMeter
+from torch.optim.lr_scheduler import ReduceLROnPlateau
+from optimizers import get_scheduler
+from utils.distributed import (
+    get_rank, get_world_size, broadcast_parameters, register_gradient_all_reduce, broadcast_values
+)
+
+
+def snapshot(obj):
+    """copy of the (nested) tensors of a state to the cpu, which the training loop can not change anymore"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    elif isinstance(obj, dict):
+        return {key: snapshot(val) for key, val in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(val) for val in obj)
+    return obj
+
+
+def get_rng_state():
+    state = {
+        "torch": torch.get_rng_state(),
+        "numpy": np.random.get_state(),
+        "random": random.getstate(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state["torch"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["random"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+# why training stopped, broadcast by index in data-parallel training
+STOP_REASONS = ("n_epoch", "early_stopping", "time_budget")
+
+
+class PhaseScheduler:
+    """
+    Decides when the periodic phases of training (val, eval, vis) run.
+    Without time_fraction, every phase runs at its configured interval. With time_fraction, a phase
+    runs at its interval until its cost is measured, afterwards it runs as soon as enough training time
+    has passed since its last run that all phases together take about time_fraction of the time.
+    Phases with interval None never run.
+    """
+    def __init__(self, intervals, time_fraction=None):
+        self.intervals = {phase: interval for phase, interval in intervals.items() if interval is not None}
+        self.time_fraction = time_fraction
+        self.cost = {}
+        self.time = {"train": 0.0, **{phase: 0.0 for phase in intervals}}
+        self._train_time_since = {phase: 0.0 for phase in self.intervals}
+
+    def add_train_time(self, seconds):
+        self.time["train"] += seconds
+        for phase in self._train_time_since:
+            self._train_time_since[phase] += seconds
+
+    def due(self, phase, i_iter):
+        if phase not in self.intervals:
+            return False
+        if self.time_fraction is None or phase not in self.cost:
+            return i_iter % self.intervals[phase] == 0
+        # the phases share the budget equally, cost / (train time + cost) = share
+        share = self.time_fraction / len(self.intervals)
+        return self._train_time_since[phase] * share >= self.cost[phase] * (1 - share)
+
+    def record(self, phase, seconds):
+        self.cost[phase] = seconds
+        self.time[phase] += seconds
+        if phase in self._train_time_since:
+            self._train_time_since[phase] = 0.0
+
+    def state_dict(self):
+        return {"cost": dict(self.cost), "time": dict(self.time), "train_time_since": dict(self._train_time_since)}
+
+    def load_state_dict(self, state):
+        """the measured costs and times continue, of the phases that are still scheduled"""
+        self.cost = {phase: cost for phase, cost in state["cost"].items() if phase in self.intervals}
+        self.time.update({phase: seconds for phase, seconds in state["time"].items() if phase in self.time})
+        for phase, seconds in state["train_time_since"].items():
+            if phase in self._train_time_since:
+                self._train_time_since[phase] = seconds
+
+    def summary(self):
+        """seconds and fraction of the total time spent in training and each phase"""
+        total = max(sum(self.time.values()), 1.0e-12)
+        d_time = {}
+        for phase, seconds in self.time.items():
+            d_time[f"time/{phase}_time_"] = seconds
+            d_time[f"time/{phase}_fraction_"] = seconds / total
+        return d_time
 
 
 class BaseTrainer:
-    """Trainer for a conventional iterative training of model for classification"""
+    """
+    Trainer for a conventional iterative training of model for classification.
+    Inside an initialized process group it trains data-parallel: every rank steps on its shard of the batch
+    with the gradients averaged over all ranks, validation, evaluation, logging and checkpoints run on rank 0.
+    """
     def __init__(self, optimizer, training_cfg, device):
         self.training_cfg = training_cfg
         self.device = device
         self.optimizer = optimizer
+        self.rank = get_rank()
+        self.world_size = get_world_size()
+        # checkpoints are written one after the other by a background thread
+        self._checkpoint_writer = ThreadPoolExecutor(max_workers=1)
+        self._pending_checkpoints = []
 
-    def train(self, model, d_dataloaders, logger=None, logdir=""):
+    def train(self, model, d_dataloaders, logger=None, logdir="", resume=None):
+        """
+        :param resume: path of a checkpoint written by this trainer, training continues where it stopped
+        """
         cfg = self.training_cfg
+        main = self.rank == 0
         time_meter = averageMeter()
         train_loader, val_loader = (d_dataloaders["training"], d_dataloaders["validation"])
         kwargs = {'dataset_size': len(train_loader.dataset)}
         i_iter = 0
         best_val_loss = np.inf
-    
-        for i_epoch in range(1, cfg['n_epoch'] + 1):
-            for x, _ in train_loader:
+        start_epoch = 1
+        skip_batches = 0
+        checkpoint_interval = cfg.get("checkpoint_interval", cfg.val_interval)
+        lr_scheduler = get_scheduler(cfg.get("scheduler", None), self.optimizer, n_epoch=cfg['n_epoch'])
+        # stop after this many validations without an improvement of at least min_delta
+        early_stopping = cfg.get("early_stopping", None)
+        bad_validations = 0
+        # wall-clock seconds of training, over all resumptions
+        time_budget = cfg.get("time_budget", None)
+        elapsed_before = 0.0
+        stop_reason = "n_epoch"
+        # evaluation and visualization in a separate process, see BackgroundEvaluator
+        evaluator = None
+        if main and cfg.get("background_eval", False):
+            from trainers.background import BackgroundEvaluator
+            evaluator = BackgroundEvaluator(model, d_dataloaders, self.device, n_threads=cfg.get("eval_threads", 1))
+        phases = PhaseScheduler(
+            {"val": cfg.val_interval, "eval": cfg.eval_interval, "vis": cfg.visualize_interval},
+            time_fraction=cfg.get("eval_time_fraction", None),
+        )
+        best_state, best_iter = None, None
+
+        if resume is not None:
+            # a checkpoint of this trainer, its rng state holds numpy arrays
+            state = torch.load(resume, map_location="cpu", weights_only=False)
+            model.load_state_dict(state["model_state"])
+            self.optimizer.load_state_dict(state["optimizer_state"])
+            logger.load_state_dict(state["logger_state"])
+            set_rng_state(state["rng_state"])
+            start_epoch, i_iter, best_val_loss = state["epoch"], state["iter"], state["best_val_loss"]
+            # checkpoints written before early stopping and the time budget existed lack these
+            bad_validations, elapsed_before = state.get("bad_validations", 0), state.get("elapsed", 0.0)
+            if lr_scheduler is not None:
+                lr_scheduler.load_state_dict(state["scheduler_state"])
+            if state.get("reg_state") is not None and hasattr(model, "load_reg_state_dict"):
+                model.load_reg_state_dict(state["reg_state"])
+            if state.get("phase_state") is not None:
+                phases.load_state_dict(state["phase_state"])
+            best_iter = state.get("best_iter")
+            if best_iter is not None:
+                # the best weights are in model_best.pkl next to the checkpoint, unless a later best model of
+                # the interrupted run replaced them
+                best_path = os.path.join(os.path.dirname(resume), "model_best.pkl")
+                best = None
+                if os.path.exists(best_path):
+                    # best checkpoints of earlier versions of this trainer also hold the rng state
+                    best = torch.load(best_path, map_location="cpu", weights_only=False)
+                if best is not None and best["iter"] == best_iter:
+                    best_state = best["model_state"]
+                else:
+                    print(f"No best weights of iter {best_iter:d} in {best_path}, they are not evaluated at the end")
+                    best_iter = None
+            if hasattr(train_loader, "load_state_dict"):
+                train_loader.load_state_dict(state["loader_state"])
+            else:
+                # a torch DataLoader can not restore its order, only the number of batches of the epoch
+                skip_batches = state["loader_state"]["position"]
+            print(f"Resumed from {resume} at epoch {start_epoch:d}, iter {i_iter:d}")
+
+        gradient_hook = None
+        if self.world_size > 1:
+            broadcast_parameters(model)
+            gradient_hook = register_gradient_all_reduce(self.optimizer)
+
+        def training_state(i_epoch, i_batch):
+            if hasattr(train_loader, "state_dict"):
+                loader_state = train_loader.state_dict()
+            else:
+                loader_state = {"position": i_batch}
+            return {
+                "optimizer_state": self.optimizer.state_dict(),
+                "logger_state": logger.state_dict(),
+                "rng_state": get_rng_state(),
+                "loader_state": loader_state,
+                "best_val_loss": best_val_loss,
+                "bad_validations": bad_validations,
+                "scheduler_state": lr_scheduler.state_dict() if lr_scheduler is not None else None,
+                "reg_state": model.reg_state_dict() if hasattr(model, "reg_state_dict") else None,
+                "phase_state": phases.state_dict(),
+                "best_iter": best_iter,
+                "elapsed": elapsed_before + time.time() - start_time,
+                "epoch": i_epoch,
+            }
+
+        last_val_iter, last_eval_iter = None, None
+
+        def validate(i_epoch, i_batch, final=False):
+            nonlocal best_val_loss, best_state, best_iter, bad_validations, stop_reason
+            for x, _ in val_loader:
+                d_val = model.validation_step(x.to(self.device))
+                logger.process_iter_val(d_val)
+            d_val = logger.summary_val(i_iter)
+            val_loss = float(d_val['loss/val_loss_'])
+            print(d_val['print_str'])
+            best_model = val_loss < best_val_loss
+
+            if isinstance(lr_scheduler, ReduceLROnPlateau):
+                lr_scheduler.step(val_loss)
+            if early_stopping is not None and not final:
+                if val_loss < best_val_loss - early_stopping.get("min_delta", 0.):
+                    bad_validations = 0
+                else:
+                    bad_validations += 1
+                if bad_validations >= early_stopping["patience"]:
+                    print(f'Iter [{i_iter:d}] no improvement in {bad_validations:d} validations, stopping')
+                    stop_reason = "early_stopping"
+
+            if best_model:
+                print(f'Iter [{i_iter:d}] best model saved {val_loss:.6f} <= {best_val_loss:.6f}')
+                best_val_loss = val_loss
+                best_state, best_iter = snapshot(model.state_dict()), i_iter
+                self.save_model(model, logdir, best=True, i_iter=i_iter)
+
+        start_time = time.time()
+        mark = time.time()
+        i_epoch, i_batch = start_epoch, 0
+        for i_epoch in range(start_epoch, cfg['n_epoch'] + 1):
+            if hasattr(getattr(train_loader, "sampler", None), "set_epoch"):
+                # reshuffles a DistributedSampler
+                train_loader.sampler.set_epoch(i_epoch)
+            for i_batch, (x, _) in enumerate(train_loader, start=1):
+                if skip_batches > 0:
+                    skip_batches -= 1
+                    continue
                 i_iter += 1
 
                 model.train()
@@ -33,54 +265,157 @@ class BaseTrainer:
                 time_meter.update(time.time() - start_ts)
                 logger.process_iter_train(d_train)
 
-                if i_iter % cfg.print_interval == 0:
+                if main and i_iter % cfg.print_interval == 0:
                     d_train = logger.summary_train(i_iter)
                     print(
                         f"Epoch [{i_epoch:d}] \nIter [{i_iter:d}]\tAvg Loss: {d_train['loss/train_loss_']:.6f}\tElapsed time: {time_meter.sum:.4f}"
                     )
                     time_meter.reset()
+                phases.add_train_time(time.time() - mark)
 
                 model.eval()
                 # logger.reset_val()
-                if i_iter % cfg.val_interval == 0:
-                    for x, _ in val_loader:
-                        d_val = model.validation_step(x.to(self.device))
-                        logger.process_iter_val(d_val)
-                    d_val = logger.summary_val(i_iter)
-                    val_loss = d_val['loss/val_loss_']
-                    print(d_val['print_str'])
-                    best_model = val_loss < best_val_loss
-
-                    if best_model:
-                        print(f'Iter [{i_iter:d}] best model saved {val_loss:.6f} <= {best_val_loss:.6f}')
-                        best_val_loss = val_loss
-                        self.save_model(model, logdir, best=True)
-                
-                if (cfg.eval_interval is not None) and (i_iter % cfg.eval_interval == 0):  
-                    d_eval = model.eval_step(val_loader, device=self.device)
-                    logger.add_val(i_iter, d_eval)
-                    print_str = f'Iter [{i_iter:d}]'
-                    for key, val in d_eval.items():
-                        if key.endswith('_'):
-                            print_str = print_str + f'\t{key[:-1]}: {val:.4f}'
-                    print(print_str)
-
-                if (cfg.visualize_interval is not None) and (i_iter % cfg.visualize_interval) == 0:
-                    d_val = model.visualization_step(train_loader, device=self.device)
-                    logger.add_val(i_iter, d_val)
-
-        self.save_model(model, logdir, i_iter="last")
+                if main and phases.due("val", i_iter):
+                    start_ts = time.time()
+                    validate(i_epoch, i_batch)
+                    last_val_iter = i_iter
+                    phases.record("val", time.time() - start_ts)
+
+                if main and phases.due("eval", i_iter):
+                    if evaluator is not None:
+                        if evaluator.submit("eval", i_iter, model):
+                            last_eval_iter = i_iter
+                    else:
+                        last_eval_iter = i_iter
+                        start_ts = time.time()
+                        d_eval = model.eval_step(val_loader, device=self.device)
+                        phases.record("eval", time.time() - start_ts)
+                        self.report(logger, "eval", i_iter, d_eval)
+
+                if main and phases.due("vis", i_iter):
+                    if evaluator is not None:
+                        evaluator.submit("vis", i_iter, model)
+                    else:
+                        start_ts = time.time()
+                        d_val = model.visualization_step(train_loader, device=self.device)
+                        phases.record("vis", time.time() - start_ts)
+                        self.report(logger, "vis", i_iter, d_val)
+
+                if evaluator is not None:
+                    # background jobs count with the time the worker spent on them
+                    for kind, i_result, d_result, seconds in evaluator.poll():
+                        phases.record(kind, seconds)
+                        self.report(logger, kind, i_result, d_result)
+
+                if main and checkpoint_interval is not None and i_iter % checkpoint_interval == 0:
+                    self.save_model(model, logdir, latest=True, i_iter=i_iter, state=training_state(i_epoch, i_batch))
+
+                if main and stop_reason == "n_epoch" and time_budget is not None and elapsed_before + time.time() - start_time > time_budget:
+                    print(f'Iter [{i_iter:d}] time budget of {time_budget}s used up, stopping')
+                    stop_reason = "time_budget"
+                if self.world_size > 1:
+                    # the other ranks follow the decisions of rank 0, on stopping and on the lr of a plateau scheduler
+                    control = broadcast_values(
+                        [STOP_REASONS.index(stop_reason)] + [group["lr"] for group in self.optimizer.param_groups]
+                    )
+                    stop_reason = STOP_REASONS[int(control[0])]
+                    for group, lr in zip(self.optimizer.param_groups, control[1:]):
+                        group["lr"] = lr
+                mark = time.time()
+                if stop_reason != "n_epoch":
+                    break
+
+            if stop_reason != "n_epoch":
+                break
+            if lr_scheduler is not None and not isinstance(lr_scheduler, ReduceLROnPlateau):
+                lr_scheduler.step()
+
+        if gradient_hook is not None:
+            gradient_hook.remove()
+        if not main:
+            return model, best_val_loss
+
+        if evaluator is not None:
+            for kind, i_result, d_result, seconds in evaluator.close():
+                phases.record(kind, seconds)
+                self.report(logger, kind, i_result, d_result)
+
+        # the final and the best weights are always validated and evaluated
+        model.eval()
+        if cfg.val_interval is not None and last_val_iter != i_iter:
+            start_ts = time.time()
+            validate(i_epoch, i_batch, final=True)
+            phases.record("val", time.time() - start_ts)
+        if cfg.eval_interval is not None:
+            start_ts = time.time()
+            if last_eval_iter != i_iter:
+                self.report(logger, "eval", i_iter, model.eval_step(val_loader, device=self.device))
+            if best_state is not None and best_iter != i_iter:
+                best_model = copy.deepcopy(model)
+                best_model.load_state_dict(best_state)
+                d_eval = best_model.eval_step(val_loader, device=self.device)
+                self.report(logger, "eval", best_iter, {f"best/{key}": val for key, val in d_eval.items()})
+            phases.record("eval", time.time() - start_ts)
+
+        d_time = phases.summary()
+        logger.add_val(i_iter, d_time)
+        print("Time split: " + ", ".join(
+            f"{key[5:-6]} {d_time[key]:.1f}s ({100 * d_time[key[:-5] + 'fraction_']:.1f}%)"
+            for key in d_time if key.endswith("_time_")
+        ))
+
+        print(f"Training stopped at iter {i_iter:d}: {stop_reason}")
+        self.save_model(model, logdir, i_iter="last", state={"stop_reason": stop_reason, "stop_iter": i_iter})
+        self.wait_for_checkpoints()
+        logger.flush()
         return model, best_val_loss
 
-    def save_model(self, model, logdir, best=False, i_iter=None, i_epoch=None):
+    @staticmethod
+    def report(logger, kind, i_iter, d_result):
+        """log the result of eval_step (kind 'eval') or visualization_step (kind 'vis')"""
+        logger.add_val(i_iter, d_result)
+        if kind == "eval":
+            print_str = f'Iter [{i_iter:d}]'
+            for key, val in d_result.items():
+                if key.endswith('_'):
+                    print_str = print_str + f'\t{key[:-1]}: {val:.4f}'
+            print(print_str)
+
+    def save_model(self, model, logdir, best=False, latest=False, i_iter=None, i_epoch=None, state=None):
+        """
+        Write a checkpoint in the background, from a copy of the current state.
+        latest is the checkpoint to resume from, state holds the training state for resuming (see train).
+        Only rank 0 writes checkpoints.
+        """
+        if self.rank != 0:
+            return
         if best:
             pkl_name = "model_best.pkl"
+        elif latest:
+            pkl_name = "model_latest.pkl"
         else:
             if i_iter is not None:
                 pkl_name = f"model_iter_{i_iter}.pkl"
             else:
                 pkl_name = f"model_epoch_{i_epoch}.pkl"
-        state = {"epoch": i_epoch, "iter": i_iter, "model_state": model.state_dict()}
+        checkpoint = {"epoch": i_epoch, "iter": i_iter, "model_state": model.state_dict()}
+        if state is not None:
+            checkpoint.update(state)
         save_path = os.path.join(logdir, pkl_name)
-        torch.save(state, save_path)
-        print(f"Model saved: {pkl_name}")
\ No newline at end of file
+        self._pending_checkpoints.append(
+            self._checkpoint_writer.submit(self._write_checkpoint, snapshot(checkpoint), save_path)
+        )
+
+    @staticmethod
+    def _write_checkpoint(checkpoint, save_path):
+        # a run preempted while writing keeps the previous checkpoint
+        tmp_path = save_path + ".tmp"
+        torch.save(checkpoint, tmp_path)
+        os.replace(tmp_path, save_path)
+        print(f"Model saved: {os.path.basename(save_path)}")
+
+    def wait_for_checkpoints(self):
+        """block until all checkpoints are written, raises the errors of the writer"""
+        for future in self._pending_checkpoints:
+            future.result()
+        self._pending_checkpoints = []
\ No newline at end of file
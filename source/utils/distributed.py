@@ -0,0 +1,79 @@
+"""
+Helpers for data-parallel training with torch.distributed (see run_distributed in train.py).
+Without an initialized process group they fall back to single process behaviour.
+"""
+
+import torch
+import torch.distributed as dist
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def broadcast_parameters(module, src=0):
+    """give all ranks the parameters and buffers of rank src"""
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        dist.broadcast(tensor.data, src=src)
+
+
+def all_reduce_gradients(params):
+    """average the gradients of params over all ranks, in a single all_reduce of the flattened gradients"""
+    params = [p for p in params if p.requires_grad]
+    grads = [p.grad if p.grad is not None else torch.zeros_like(p) for p in params]
+    flat = torch.cat([grad.reshape(-1) for grad in grads])
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+
+    offset = 0
+    for p in params:
+        n = p.numel()
+        p.grad = flat[offset:offset + n].view_as(p)
+        offset += n
+
+
+def register_gradient_all_reduce(optimizer):
+    """average the gradients over all ranks right before every optimizer step"""
+    params = [p for group in optimizer.param_groups for p in group["params"]]
+
+    def hook(optimizer, args, kwargs):
+        all_reduce_gradients(params)
+
+    return optimizer.register_step_pre_hook(hook)
+
+
+def batch_var(x):
+    """
+    Unbiased variance of x over the samples of all ranks, differentiable w.r.t. the local samples.
+    The variance of the local shard alone is not the variance of the batch.
+    """
+    if not is_distributed():
+        return torch.var(x)
+    from torch.distributed.nn.functional import all_reduce
+
+    n = torch.tensor([float(len(x))], device=x.device)
+    dist.all_reduce(n)
+    # shift by the (constant) global mean against cancellation in the sum of squares
+    shift = x.detach().sum()
+    dist.all_reduce(shift)
+    shift = shift / n[0]
+
+    # the backward pass of the differentiable all_reduce sums the incoming gradients of all ranks, i.e. scales
+    # them by world_size, which cancels the averaging of all_reduce_gradients
+    sums = all_reduce(torch.stack([(x - shift).sum(), ((x - shift) ** 2).sum()]))
+    return (sums[1] - sums[0] ** 2 / n[0]) / (n[0] - 1)
+
+
+def broadcast_values(values, src=0):
+    """the list of floats values of rank src, on all ranks, as one small tensor without pickling"""
+    values = torch.tensor(values, dtype=torch.float64)
+    dist.broadcast(values, src=src)
+    return values.tolist()
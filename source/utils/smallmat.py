@@ -0,0 +1,153 @@
+"""
+Closed form linear algebra for batches of small symmetric (positive definite) matrices.
+
+Most of our metrics are 2x2 (z_dim 2) or 3x3 (EARTH). For those, determinant, inverse and
+spectrum are computed with vectorized closed form expressions instead of one LAPACK call
+per matrix. Larger matrices fall back to torch.linalg.
+All functions take tensors of shape (..., n, n).
+"""
+
+import math
+
+import torch
+
+
+def det(G):
+    n = G.shape[-1]
+    if n == 2:
+        return G[..., 0, 0] * G[..., 1, 1] - G[..., 0, 1] * G[..., 1, 0]
+    elif n == 3:
+        return (
+            G[..., 0, 0] * (G[..., 1, 1] * G[..., 2, 2] - G[..., 1, 2] * G[..., 2, 1])
+            - G[..., 0, 1] * (G[..., 1, 0] * G[..., 2, 2] - G[..., 1, 2] * G[..., 2, 0])
+            + G[..., 0, 2] * (G[..., 1, 0] * G[..., 2, 1] - G[..., 1, 1] * G[..., 2, 0])
+        )
+    return torch.det(G)
+
+
+def logdet(G):
+    """
+    log determinant of SPD matrices (nan for a non-positive determinant, as torch.logdet)
+    """
+    if G.shape[-1] in [2, 3]:
+        return torch.log(det(G))
+    return torch.logdet(G)
+
+
+def inv(G):
+    n = G.shape[-1]
+    if n == 2:
+        adj = torch.stack(
+            [
+                torch.stack([G[..., 1, 1], -G[..., 0, 1]], dim=-1),
+                torch.stack([-G[..., 1, 0], G[..., 0, 0]], dim=-1),
+            ],
+            dim=-2,
+        )
+        return adj / det(G)[..., None, None]
+    elif n == 3:
+        # rows of the inverse are the cross products of the columns of G
+        c0, c1, c2 = G[..., :, 0], G[..., :, 1], G[..., :, 2]
+        adj = torch.stack(
+            [
+                torch.linalg.cross(c1, c2),
+                torch.linalg.cross(c2, c0),
+                torch.linalg.cross(c0, c1),
+            ],
+            dim=-2,
+        )
+        return adj / det(G)[..., None, None]
+    return torch.inverse(G)
+
+
+def eigvalsh(G):
+    """
+    eigenvalues of symmetric matrices in ascending order
+    """
+    n = G.shape[-1]
+    if n == 2:
+        mean = (G[..., 0, 0] + G[..., 1, 1]) / 2
+        radius = torch.sqrt(((G[..., 0, 0] - G[..., 1, 1]) / 2) ** 2 + G[..., 0, 1] ** 2)
+        return torch.stack([mean - radius, mean + radius], dim=-1)
+    elif n == 3:
+        return _eigvalsh3(G)
+    return torch.linalg.eigvalsh(G)
+
+
+def _eigvalsh3(G):
+    # trigonometric solution of the characteristic polynomial (Smith, 1961)
+    q = torch.einsum("...ii -> ...", G) / 3
+    off = G[..., 0, 1] ** 2 + G[..., 0, 2] ** 2 + G[..., 1, 2] ** 2
+    p = torch.sqrt(
+        ((G[..., 0, 0] - q) ** 2 + (G[..., 1, 1] - q) ** 2 + (G[..., 2, 2] - q) ** 2 + 2 * off) / 6
+    )
+
+    # multiples of the identity have p == 0, all eigenvalues are q then
+    p_safe = torch.where(p > 0, p, torch.ones_like(p))
+    eye = torch.eye(3, dtype=G.dtype, device=G.device)
+    B = (G - q[..., None, None] * eye) / p_safe[..., None, None]
+    r = torch.clip(det(B) / 2, min=-1.0, max=1.0)
+    phi = torch.acos(r) / 3
+
+    largest = q + 2 * p * torch.cos(phi)
+    smallest = q + 2 * p * torch.cos(phi + 2 * math.pi / 3)
+    middle = 3 * q - largest - smallest
+    return torch.stack([smallest, middle, largest], dim=-1)
+
+
+def eigh(G):
+    """
+    eigenvalues in ascending order and the corresponding eigenvectors (as columns) of symmetric matrices
+    """
+    n = G.shape[-1]
+    if n == 2:
+        eigvals = eigvalsh(G)
+        # angle of the eigenvector of the largest eigenvalue
+        theta = 0.5 * torch.atan2(2 * G[..., 0, 1], G[..., 0, 0] - G[..., 1, 1])
+        cos, sin = torch.cos(theta), torch.sin(theta)
+        eigvecs = torch.stack(
+            [torch.stack([-sin, cos], dim=-1), torch.stack([cos, sin], dim=-1)], dim=-1
+        )
+        return eigvals, eigvecs
+    elif n == 3:
+        return _eigh3(G)
+    return torch.linalg.eigh(G)
+
+
+def _eigh3(G, eps=1.0e-6):
+    eigvals = _eigvalsh3(G)
+    eye = torch.eye(3, dtype=G.dtype, device=G.device)
+
+    def null_vector(eigval):
+        # the eigenvector is orthogonal to the rows of G - eigval I, take the best conditioned cross product
+        M = G - eigval[..., None, None] * eye
+        candidates = torch.stack(
+            [
+                torch.linalg.cross(M[..., 0, :], M[..., 1, :]),
+                torch.linalg.cross(M[..., 0, :], M[..., 2, :]),
+                torch.linalg.cross(M[..., 1, :], M[..., 2, :]),
+            ],
+            dim=-2,
+        )
+        norms = torch.linalg.norm(candidates, dim=-1)
+        best = norms.argmax(dim=-1, keepdim=True)
+        v = torch.gather(candidates, -2, best[..., None].expand(*best.shape, 3)).squeeze(-2)
+        norm = torch.gather(norms, -1, best).squeeze(-1)
+        return v / torch.clip(norm, min=torch.finfo(G.dtype).tiny)[..., None], norm
+
+    v_small, norm_small = null_vector(eigvals[..., 0])
+    v_large, norm_large = null_vector(eigvals[..., 2])
+    v_middle = torch.linalg.cross(v_large, v_small)
+    eigvecs = torch.stack([v_small, v_middle, v_large], dim=-1)
+
+    # (nearly) repeated eigenvalues have no well defined cross products, use LAPACK for those
+    scale = torch.clip(eigvals.abs().amax(dim=-1), min=torch.finfo(G.dtype).tiny) ** 2
+    degenerate = (norm_small < eps * scale) | (norm_large < eps * scale)
+    if degenerate.any():
+        fallback = torch.linalg.eigh(G[degenerate])
+        eigvals = eigvals.clone()
+        eigvecs = eigvecs.clone()
+        eigvals[degenerate] = fallback.eigenvalues
+        eigvecs[degenerate] = fallback.eigenvectors
+
+    return eigvals, eigvecs
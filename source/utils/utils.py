@@ -11,6 +11,7 @@ from matplotlib import cm
 import functorch
 
 from utils.config import Config
+from utils import smallmat
 
 config = Config()
 
@@ -51,20 +52,34 @@ def figure_to_array(fig):
     return np.array(fig.canvas.renderer._renderer)
 
 
-def PD_metric_to_ellipse(G, center, scale, **kwargs):
-    # eigen decomposition
-    eigvals, eigvecs = np.linalg.eigh(G)
-    order = eigvals.argsort()[::-1]
-    eigvals, eigvecs = eigvals[order], eigvecs[:, order]
+def PD_metrics_to_ellipse_params(G, scale):
+    """
+    widths, heights and angles (in degrees) of the ellipses of a batch of 2x2 PD metrics G
+    """
+    # eigen decomposition, largest eigenvalue first
+    eigvals, eigvecs = smallmat.eigh(torch.as_tensor(np.asarray(G)))
+    eigvals, eigvecs = eigvals.flip(-1).numpy(), eigvecs.flip(-1).numpy()
 
     # find angle of ellipse
-    vx, vy = eigvecs[:, 0][0], eigvecs[:, 0][1]
+    vx, vy = eigvecs[:, 0, 0], eigvecs[:, 1, 0]
     theta = np.arctan2(vy, vx)
 
+    sizes = 2 * scale * np.sqrt(eigvals)
+    return sizes[:, 0], sizes[:, 1], np.degrees(theta)
+
+
+def PD_metric_to_ellipse(G, center, scale, ellipse_params=None, **kwargs):
+    """
+    ellipse_params: (width, height, angle) if they were already computed with PD_metrics_to_ellipse_params
+    """
+    if ellipse_params is None:
+        widths, heights, angles = PD_metrics_to_ellipse_params(np.asarray(G)[None], scale)
+        ellipse_params = widths[0], heights[0], angles[0]
+    width, height, angle = ellipse_params
+
     # draw ellipse
-    width, height = 2 * scale * np.sqrt(eigvals)
     return Ellipse(
-        xy=center, width=width, height=height, angle=np.degrees(theta), **kwargs
+        xy=center, width=width, height=height, angle=angle, **kwargs
     )
 
 
@@ -106,12 +121,13 @@ def cmap_labels(labels, cmap=cm.turbo):
     return new_labels
 
 
-def batch_jacobian(f, input, mode):
+def batch_jacobian(f, input, mode, has_aux=False):
     """
     Compute the diagonal entries of the jacobian of f with respect to x
     :param f: the function
     :param x: where it is to be evaluated
-    :return: diagonal of df/dx. First dimension is the derivative
+    :param has_aux: f returns a tuple (output, aux), aux is passed through
+    :return: diagonal of df/dx. First dimension is the derivative (and aux if has_aux)
     """
 
     # compute vectorized jacobian. For curvature because of nested derivatives, for some of the functions
@@ -125,9 +141,9 @@ def batch_jacobian(f, input, mode):
     # else:
 
     if mode == "rev":
-        jac = functorch.vmap(functorch.jacrev(f), in_dims=(0,))(input)
+        jac = functorch.vmap(functorch.jacrev(f, has_aux=has_aux), in_dims=(0,))(input)
     elif mode == "fwd":
-        jac = functorch.vmap(functorch.jacfwd(f), in_dims=(0,))(input)
+        jac = functorch.vmap(functorch.jacfwd(f, has_aux=has_aux), in_dims=(0,))(input)
     else:
         raise NotImplementedError
 
@@ -406,11 +422,11 @@ def random_metric_field_generator(
     if local_coordinates == "exponential":
         S = torch.randn(num_samples, dim, dim) * sigma
         S = (S + S.permute(0, 2, 1)) / 2
-        eigh = torch.linalg.eigh(S)
+        eigenvalues, eigenvectors = smallmat.eigh(S)
         random_G = (
-            eigh.eigenvectors
-            @ torch.diag_embed(torch.exp(eigh.eigenvalues))
-            @ (eigh.eigenvectors.permute(0, 2, 1))
+            eigenvectors
+            @ torch.diag_embed(torch.exp(eigenvalues))
+            @ (eigenvectors.permute(0, 2, 1))
         )
     elif local_coordinates == "cholesky":
         S = torch.randn(num_samples, dim, dim) * sigma